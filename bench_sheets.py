@@ -0,0 +1,175 @@
+"""Бенчмарк пути сохранения клиентов в Google Sheets на FakeWorksheet.
+
+Подает поток регистраций в save_to_google_sheets с заданной частотой и
+прогоняет несколько сценариев: стабильная работа, случайные ошибки, квота
+(429), полный отказ Sheets в середине прогона, повторные оплаты тех же
+клиентов (перезапись строки вместо дубля) и падение процесса с
+последующей досылкой заявок из outbox. Для каждого сценария печатает
+пропускную способность, задержку постановки в очередь (вместе с fsync
+outbox), размер очереди в конце нагрузки и сколько клиентов не попало в
+таблицу после остановки.
+
+Пример:
+    python bench_sheets.py --rate 20 --duration 30
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("PORT", "10090")
+os.environ["SHEETS_BACKEND"] = "fake"
+
+import bot  # noqa: E402
+from fake_sheets import FakeWorksheet, HEADERS  # noqa: E402
+
+SCENARIOS = {
+    "steady": {},
+    "errors": {"error_rate": 0.1},
+    "quota": {"quota_per_minute": 30},
+    "outage": {"outage": True},
+    "resubscribe": {"repeat_rate": 0.3},
+    "crash": {"crash": True},
+}
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def run_scenario(name: str, options: dict, args) -> dict:
+    sheet = FakeWorksheet(
+        latency=args.latency / 1000,
+        jitter=args.jitter / 1000,
+        error_rate=options.get("error_rate", 0),
+        quota_per_minute=options.get("quota_per_minute", 0),
+        headers=HEADERS,
+        seed=1
+    )
+    outbox_path = os.path.join(tempfile.mkdtemp(prefix="bench-outbox-"), "outbox.sqlite3")
+    writer = bot.SheetsWriter(bot.SHEETS_BATCH_SIZE, bot.SHEETS_FLUSH_INTERVAL, bot.Outbox(outbox_path))
+    bot.SHEET = sheet
+    bot.SHEETS_STATE = "ready"
+    bot.SHEETS_WRITER = writer
+    bot.CUSTOMERS = bot.CustomerIndex()
+    await bot.load_customer_index()
+    await writer.start()
+
+    total = int(args.rate * args.duration)
+    chooser = random.Random(2)
+    submitted = set()
+    enqueue_times = []
+    max_depth = 0
+    started = time.perf_counter()
+    for index in range(total):
+        if options.get("outage"):
+            sheet.down = args.duration / 3 <= time.perf_counter() - started < 2 * args.duration / 3
+
+        user_index = index
+        if index and chooser.random() < options.get("repeat_rate", 0):
+            user_index = chooser.randrange(index)
+        submitted.add(str(700000000 + user_index))
+
+        call_started = time.perf_counter()
+        await bot.save_to_google_sheets({
+            "user_id": 700000000 + user_index,
+            "username": f"bench{user_index}",
+            "name": "Bench",
+            "tariff": "1 месяц (3000 ₽)",
+            "email": f"bench{user_index}+{index}@example.com"
+        })
+        enqueue_times.append(time.perf_counter() - call_started)
+        max_depth = max(max_depth, writer.depth)
+
+        delay = started + (index + 1) / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    sheet.down = False
+    backlog = writer.depth
+    load_elapsed = time.perf_counter() - started
+
+    if options.get("crash"):
+        # Процесс "падает": задача записи исчезает вместе с очередью в памяти,
+        # новый процесс поднимает заявки из того же outbox
+        writer._task.cancel()
+        writer = bot.SheetsWriter(bot.SHEETS_BATCH_SIZE, bot.SHEETS_FLUSH_INTERVAL, bot.Outbox(outbox_path))
+        bot.SHEETS_WRITER = writer
+        bot.CUSTOMERS = bot.CustomerIndex()
+        await bot.load_customer_index()
+        await writer.start()
+
+    try:
+        await asyncio.wait_for(writer.stop(), timeout=args.drain_timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+
+    saved_ids = [row[0] for row in sheet.data_rows()]
+    persisted = len(set(saved_ids) & submitted)
+    # Не записанные в таблицу, но сохраненные в outbox заявки будут досланы после перезапуска
+    unsynced = {row[0] for _, row in writer.outbox.pending()} - set(saved_ids)
+    return {
+        "scenario": name,
+        "signups": total,
+        "customers": len(submitted),
+        "persisted": persisted,
+        "duplicates": len(saved_ids) - len(set(saved_ids)),
+        "backlog_after_load": backlog,
+        "replayed": writer.rows_replayed,
+        "unsynced_in_outbox": len(unsynced),
+        "lost_after_stop": len(submitted - set(saved_ids) - unsynced),
+        "max_queue_depth": max_depth,
+        "throughput_rows_per_s": round(persisted / elapsed, 1) if elapsed else 0,
+        "load_seconds": round(load_elapsed, 1),
+        "drain_seconds": round(elapsed - load_elapsed, 1),
+        "enqueue_p50_us": round(percentile(enqueue_times, 0.50) * 1e6, 1),
+        "enqueue_p99_us": round(percentile(enqueue_times, 0.99) * 1e6, 1),
+        "sheet_calls": dict(sheet.calls),
+        "sheet_errors": sum(sheet.errors.values()),
+    }
+
+
+async def run_all(args) -> list:
+    results = []
+    for name in args.scenarios:
+        results.append(await run_scenario(name, SCENARIOS[name], args))
+    return results
+
+
+def print_report(results: list):
+    columns = [
+        ("scenario", "Сценарий", 12), ("signups", "Заявок", 8), ("customers", "Клиентов", 10),
+        ("persisted", "Записано", 10), ("duplicates", "Дублей", 8),
+        ("backlog_after_load", "В outbox", 10), ("replayed", "Дослано", 9),
+        ("unsynced_in_outbox", "Ждут повтора", 14), ("lost_after_stop", "Потеряно", 10),
+        ("max_queue_depth", "Макс. очередь", 15), ("throughput_rows_per_s", "Строк/с", 9),
+        ("enqueue_p99_us", "p99 постановки, мкс", 21), ("sheet_errors", "Ошибок API", 12),
+    ]
+    print("".join(f"{title:>{width}}" for _, title, width in columns))
+    for result in results:
+        print("".join(f"{str(result[key]):>{width}}" for key, _, width in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк записи клиентов в Google Sheets")
+    parser.add_argument("--rate", type=float, default=20, help="регистраций в секунду")
+    parser.add_argument("--duration", type=float, default=15, help="длительность нагрузки, сек")
+    parser.add_argument("--latency", type=float, default=300, help="задержка Sheets API, мс")
+    parser.add_argument("--jitter", type=float, default=200, help="разброс задержки, мс")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="сколько ждать выгрузки очереди, сек")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    args = parser.parse_args()
+
+    logging.getLogger(bot.__name__).setLevel(logging.WARNING)
+    print_report(asyncio.run(run_all(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,238 @@
+import time
+BOOT_STARTED = time.perf_counter()  # до тяжелых импортов (telegram, gspread), см. STARTUP
+
 import os
+import sys
+import subprocess
 import logging
+import logging.handlers
 import gspread
 import datetime
 import asyncio
 import threading
 import json
-import time
+import contextlib
+import contextvars
 import urllib.request
+import urllib.parse
 import ssl
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import collections
+import bisect
+import functools
+import hashlib
+import sqlite3
+import types
+import queue
+import random
+import re
+import atexit
+import signal
+import gzip
+import gc
+import hmac
+import tracemalloc
+import copy
+import uuid
+import httpx
 from oauth2client.service_account import ServiceAccountCredentials
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, BotCommand
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, CallbackQueryHandler, BasePersistence, PersistenceInput, BaseRateLimiter, BaseUpdateProcessor
+
+# === ПРОЦЕССЫ (ШАРДЫ) ===
+# В режиме webhook при BOT_WORKERS > 1 основной процесс (шард 0) принимает
+# обновления и раздает их дочерним процессам BOT_SHARD=1..N-1 по user_id
+BOT_WORKERS = max(1, int(os.environ.get("BOT_WORKERS", 1)))
+SHARD_ID = int(os.environ.get("BOT_SHARD", 0))
+
+def shard_path(path: str) -> str:
+    """Локальный файл процесса: у дочерних шардов свой (outbox.sqlite3 -> outbox.sqlite3.shard1)"""
+    return f"{path}.shard{SHARD_ID}" if SHARD_ID and path != ":memory:" else path
 
 # === НАСТРОЙКИ ЛОГИРОВАНИЯ ===
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Запись в файл и в консоль идет в отдельном потоке: обработчики только
+# кладут запись в очередь и не ждут диска
+LOG_FILE = shard_path(os.environ.get("LOG_FILE", "bot.log"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json | text (формат файла)
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 5 * 1024 * 1024))  # 0 - без ротации по размеру
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "midnight")  # none - без ротации по времени
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 7))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# Доля записанных INFO-событий для частых сообщений (каждое обращение пользователя, запросы httpx)
+LOG_INFO_SAMPLE_RATE = min(1.0, max(0.0, float(os.environ.get("LOG_INFO_SAMPLE_RATE", 0.1))))
+LOG_SAMPLED_LOGGERS = ("httpx",)
+
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+EXCEPTION_FORMATTER = logging.Formatter()
+
+# extra для частых INFO-сообщений: они попадают в лог с вероятностью LOG_INFO_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+# Стандартные поля LogRecord, все остальное (extra) попадает в JSON отдельными ключами
+LOG_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS:
+                data[key] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Ротация файла лога по времени (when) и по размеру (max_bytes).
+
+    Архивы называются bot.log.ГГГГ-ММ-ДД_ЧЧ-ММ-СС, хранится backup_count последних.
+    """
+
+    def __init__(self, filename: str, when: str, max_bytes: int, backup_count: int):
+        self.rotate_by_time = when.lower() != "none"
+        super().__init__(
+            filename,
+            when=when if self.rotate_by_time else "midnight",
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True
+        )
+        self.max_bytes = max_bytes
+        # Одинаковый формат имени для ротаций по времени и по размеру
+        self.suffix = "%Y-%m-%d_%H-%M-%S"
+        self.extMatch = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(\.\d+)?$", re.ASCII)
+        if not self.rotate_by_time:
+            self.rolloverAt = float("inf")
+        self._formatted = (None, "")  # (запись, текст): shouldRollover и emit форматируют ее один раз
+
+    def format(self, record: logging.LogRecord) -> str:
+        last_record, text = self._formatted
+        if last_record is not record:
+            text = super().format(record)
+            self._formatted = (record, text)
+        return text
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rotate_by_time and time.time() >= self.rolloverAt:
+            return True
+        if self.max_bytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            # max_bytes - лимит в байтах, а кириллица в UTF-8 занимает по 2 байта
+            if self.stream.tell() + len(self.format(record).encode("utf-8")) + 1 >= self.max_bytes:
+                return True
+        return False
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        target = self.rotation_filename(f"{self.baseFilename}.{time.strftime(self.suffix)}")
+        index = 1
+        while os.path.exists(target):
+            target = self.rotation_filename(f"{self.baseFilename}.{time.strftime(self.suffix)}.{index}")
+            index += 1
+        if os.path.exists(self.baseFilename):
+            self.rotate(self.baseFilename, target)
+        if self.backupCount > 0:
+            for path in self.getFilesToDelete():
+                os.remove(path)
+
+        now = int(time.time())
+        if self.rotate_by_time and now >= self.rolloverAt:
+            self.rolloverAt = self.computeRollover(now)
+
+class InfoSampler(logging.Filter):
+    """Пропускает только часть частых INFO-сообщений (WARNING и выше - всегда)"""
+
+    def __init__(self, rate: float, loggers=()):
+        super().__init__()
+        self.rate = rate
+        self.loggers = tuple(loggers)
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.INFO or self.rate >= 1.0:
+            return True
+        if not getattr(record, "sampled", False) and not record.name.startswith(self.loggers):
+            return True
+        if random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не блокирует"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Текст сообщения и трейсбек считаются здесь, форматирование - в потоке записи"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    """Очередь логов на стороне приложения и поток записи в файл и консоль"""
+    file_handler = SizedTimedRotatingFileHandler(LOG_FILE, LOG_ROTATE_WHEN, LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_LOG_FORMAT))
+
+    queue_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(InfoSampler(LOG_INFO_SAMPLE_RATE, LOG_SAMPLED_LOGGERS))
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [queue_handler]
+    listener.start()
+    atexit.register(stop_logging, listener)
+    queue_handler.listener = listener
+    return queue_handler
+
+def stop_logging(listener):
+    """Дописать оставшиеся записи из очереди при выходе"""
+    try:
+        listener.stop()
+    except Exception:
+        pass
+
+LOG_HANDLER = setup_logging()
 logger = logging.getLogger(__name__)
 
+def logging_stats() -> dict:
+    sampler = LOG_HANDLER.filters[0]
+    return {
+        "queued": LOG_HANDLER.queue.qsize(),
+        "dropped_queue_full": LOG_HANDLER.dropped,
+        "sampled_out": sampler.dropped,
+        "info_sample_rate": sampler.rate
+    }
+
 # === КОНСТАНТЫ ===
 TOKEN = os.getenv("BOT_TOKEN")
 if not TOKEN:
@@ -32,28 +241,1235 @@ if not TOKEN:
 
 PORT = int(os.environ.get("PORT", 10000))
 
-# Состояния пользователя
-USER_STATES = {}
+# Адрес Bot API (для нагрузочного теста можно направить на fake_telegram.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+USE_WEBHOOK = BOT_MODE == "webhook" and bool(WEBHOOK_URL)
+# Несколько процессов только в режиме webhook (см. ShardRouter). Запись в Google Sheets,
+# индексы клиентов и статистики, /stats и /broadcast - только в основном процессе (шард 0)
+SHARDED = USE_WEBHOOK and BOT_WORKERS > 1
+
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    logger.warning("BOT_MODE=webhook, но WEBHOOK_URL не задан - используем polling")
+
+# Тарифы: callback_data -> название и цена в рублях
+TARIFFS = {
+    'tariff_15': {'title': '15 дней (1990 ₽)', 'price': 1990},
+    'tariff_30': {'title': '1 месяц (3000 ₽)', 'price': 3000},
+    'tariff_90': {'title': '3 месяца (6990 ₽)', 'price': 6990}
+}
+TARIFF_PRICES = {tariff['title']: tariff['price'] for tariff in TARIFFS.values()}
 
 # Глобальная переменная для времени старта
 start_time = time.time()
 
+# === ФАЗЫ ЗАПУСКА ===
+class StartupTimeline:
+    """Замеры запуска для /status: длительность фаз и моменты готовности.
+
+    Время считается в миллисекундах от начала импорта bot.py. Фазы могут
+    идти параллельно (например, авторизация в Google в фоне).
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = {}  # название -> {"start_ms", "duration_ms"}
+        self.marks = {}   # событие -> момент, мс
+
+    def _ms(self, moment: float) -> float:
+        return round((moment - self.started) * 1000, 1)
+
+    def record(self, name: str, phase_started: float, phase_finished: float = None):
+        phase_finished = phase_finished or time.perf_counter()
+        self.phases[name] = {
+            "start_ms": self._ms(phase_started),
+            "duration_ms": round((phase_finished - phase_started) * 1000, 1)
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        phase_started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, phase_started)
+
+    def mark(self, name: str):
+        """Отметить событие (повторные отметки игнорируются)"""
+        self.marks.setdefault(name, self._ms(time.perf_counter()))
+
+    def snapshot(self) -> dict:
+        return {"phases": dict(self.phases), "marks": dict(self.marks)}
+
+STARTUP = StartupTimeline(BOOT_STARTED)
+STARTUP.record("imports", BOOT_STARTED)
+
+# === ХРАНИЛИЩЕ СЕССИЙ ===
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 6 * 3600))  # секунд бездействия до удаления сессии
+SESSION_MAX_USERS = int(os.environ.get("SESSION_MAX_USERS", 10000))
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")  # memory | sqlite | shared
+SESSION_DB = shard_path(os.environ.get("SESSION_DB", "sessions.sqlite3"))
+SESSION_SHARED_DB = os.environ.get("SESSION_SHARED_DB", "shared_sessions.sqlite3")  # общая для всех процессов
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", 30))
+SESSION_BUSY_TIMEOUT = float(os.environ.get("SESSION_BUSY_TIMEOUT", 0.05))  # сек ожидания блокировки общей базы в обработчике
+SESSION_PURGE_BATCH = 500  # сессий за одну транзакцию очистки
+
+class SessionStore:
+    """Сессии пользователей в памяти процесса: user_id -> состояние воронки (или None).
+
+    Кроме состояния сессия хранит небольшой словарь данных (выбранный тариф
+    и т.п.), нужный следующим шагам воронки. Тот же интерфейс реализует
+    SharedSessionStore, поэтому обработчики не зависят от хранилища.
+
+    Сессия продлевается при каждом обновлении от пользователя и удаляется
+    после SESSION_TTL секунд бездействия или при превышении лимита
+    SESSION_MAX_USERS (вытесняется самая давняя). При удалении вызывается
+    on_evict, чтобы освободить и context.user_data пользователя.
+    """
+
+    def __init__(self, ttl: float, max_size: int, on_evict=None):
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.on_evict = on_evict
+        self._data = collections.OrderedDict()  # user_id -> [состояние, время последней активности, данные]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _alive(self, user_id):
+        entry = self._data.get(user_id)
+        if entry and time.time() - entry[1] > self.ttl:
+            self._remove(user_id)
+            self.expirations += 1
+            return None
+        return entry
+
+    def _remove(self, user_id):
+        self._data.pop(user_id, None)
+        if self.on_evict:
+            try:
+                self.on_evict(user_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка при освобождении сессии {user_id}: {e}")
+
+    def _shrink(self):
+        while len(self._data) > self.max_size:
+            user_id = next(iter(self._data))
+            self._remove(user_id)
+            self.evictions += 1
+
+    def get(self, user_id, default=None):
+        entry = self._alive(user_id)
+        if entry is None or entry[0] is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __contains__(self, user_id) -> bool:
+        entry = self._alive(user_id)
+        return entry is not None and entry[0] is not None
+
+    def __setitem__(self, user_id, state):
+        entry = self._alive(user_id)
+        self._data[user_id] = [state, time.time(), entry[2] if entry else None]
+        self._data.move_to_end(user_id)
+        self._shrink()
+
+    def pop(self, user_id, default=None):
+        """Сбросить состояние воронки, сохранив саму сессию"""
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] is None:
+            return default
+        state, entry[0] = entry[0], None
+        return state
+
+    def peek(self, user_id):
+        """Состояние без учета в счетчиках и без продления"""
+        entry = self._data.get(user_id)
+        return entry[0] if entry else None
+
+    def touch(self, user_id):
+        """Продлить сессию пользователя (создать, если ее нет)"""
+        entry = self._alive(user_id)
+        if entry is None:
+            self._data[user_id] = [None, time.time(), None]
+            self._shrink()
+        else:
+            entry[1] = time.time()
+            self._data.move_to_end(user_id)
+
+    def get_data(self, user_id) -> dict:
+        """Данные сессии (копия); пустой словарь, если их нет"""
+        entry = self._alive(user_id)
+        return dict(entry[2]) if entry and entry[2] else {}
+
+    def update_data(self, user_id, **values):
+        """Дополнить данные сессии (создать сессию, если ее нет)"""
+        entry = self._alive(user_id)
+        if entry is None:
+            self.touch(user_id)
+            entry = self._data[user_id]
+        entry[2] = {**(entry[2] or {}), **values}
+
+    def dump(self) -> list:
+        """Все сессии для снимка: [[user_id, состояние, время активности, данные], ...]"""
+        return [[user_id, *entry] for user_id, entry in self._data.items()]
+
+    def restore(self, user_id, state, touched_at: float, data: dict = None):
+        """Восстановить сессию из хранилища без продления"""
+        self._data[user_id] = [state, touched_at, data or None]
+        self._shrink()
+
+    def purge_expired(self) -> int:
+        """Удалить все просроченные сессии (самые давние стоят в начале)"""
+        deadline = time.time() - self.ttl
+        purged = 0
+        while self._data:
+            user_id, (_, touched_at, _) = next(iter(self._data.items()))
+            if touched_at > deadline:
+                break
+            self._remove(user_id)
+            purged += 1
+        self.expirations += purged
+        return purged
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "sessions": len(self._data),
+            "waiting": sum(1 for state, *_ in list(self._data.values()) if state is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "ttl_seconds": self.ttl,
+            "max_size": self.max_size
+        }
+
+class SharedSessionStore:
+    """Сессии в общей базе SQLite: их видят все процессы бота на этом хосте.
+
+    Интерфейс как у SessionStore. Запросы по одному пользователю короткие
+    (WAL, без fsync на каждую запись) и выполняются прямо в обработчике с
+    коротким ожиданием блокировки busy_timeout: чужие записи держат ее
+    микросекунды. Если база все же занята дольше, запрос повторяется с
+    полным ожиданием (счетчик busy в stats), чтобы не потерять состояние.
+    Просроченная сессия при обращении считается пустой, а удаляется и
+    вытесняется сверх max_size периодической очисткой в отдельном потоке
+    и соединении небольшими транзакциями (purge_expired_async).
+    """
+
+    def __init__(self, path: str, ttl: float, max_size: int, on_evict=None, busy_timeout: float = SESSION_BUSY_TIMEOUT):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max(1, max_size)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.busy = 0
+        self.busy_timeout = busy_timeout
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, state TEXT, data TEXT, touched_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_touched ON sessions (touched_at)")
+        self._conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout * 1000)}")
+        # Очистка идет в потоке через свое соединение и не занимает соединение обработчиков
+        self._purge_lock = threading.Lock()
+        self._purge_conn = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+
+    def _execute(self, sql: str, params=()) -> list:
+        with self._lock:
+            try:
+                return self._conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                self.busy += 1
+                logger.warning(f"⚠️ Общая база сессий занята дольше {self.busy_timeout} сек, ждем полный таймаут")
+                self._conn.execute("PRAGMA busy_timeout = 5000")
+                try:
+                    return self._conn.execute(sql, params).fetchall()
+                finally:
+                    self._conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}")
+
+    def _row(self, user_id):
+        """(состояние, данные) живой сессии или None"""
+        rows = self._execute(
+            "SELECT state, data FROM sessions WHERE user_id = ? AND touched_at > ?",
+            (user_id, time.time() - self.ttl)
+        )
+        return rows[0] if rows else None
+
+    def __len__(self) -> int:
+        return self._execute("SELECT COUNT(*) FROM sessions")[0][0]
+
+    def get(self, user_id, default=None):
+        row = self._row(user_id)
+        if row is None or row[0] is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return row[0]
+
+    def __getitem__(self, user_id):
+        value = self.get(user_id)
+        if value is None:
+            raise KeyError(user_id)
+        return value
+
+    def __contains__(self, user_id) -> bool:
+        row = self._row(user_id)
+        return row is not None and row[0] is not None
+
+    def __setitem__(self, user_id, state):
+        self._execute(
+            "INSERT INTO sessions (user_id, state, touched_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, touched_at = excluded.touched_at",
+            (user_id, state, time.time())
+        )
+
+    def pop(self, user_id, default=None):
+        """Сбросить состояние воронки, сохранив саму сессию"""
+        row = self._row(user_id)
+        if row is None or row[0] is None:
+            return default
+        self._execute("UPDATE sessions SET state = NULL WHERE user_id = ?", (user_id,))
+        return row[0]
+
+    def peek(self, user_id):
+        rows = self._execute("SELECT state FROM sessions WHERE user_id = ?", (user_id,))
+        return rows[0][0] if rows else None
+
+    def touch(self, user_id):
+        """Продлить сессию одним запросом; просроченная начинается заново"""
+        now = time.time()
+        self._execute(
+            "INSERT INTO sessions (user_id, touched_at) VALUES (?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET "
+            "state = CASE WHEN touched_at > ? THEN state END, "
+            "data = CASE WHEN touched_at > ? THEN data END, "
+            "touched_at = excluded.touched_at",
+            (user_id, now, now - self.ttl, now - self.ttl)
+        )
+
+    def get_data(self, user_id) -> dict:
+        row = self._row(user_id)
+        return json.loads(row[1]) if row and row[1] else {}
+
+    def update_data(self, user_id, **values):
+        data = {**self.get_data(user_id), **values}
+        self._execute(
+            "INSERT INTO sessions (user_id, data, touched_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, touched_at = excluded.touched_at",
+            (user_id, json.dumps(data, ensure_ascii=False), time.time())
+        )
+
+    def restore(self, user_id, state, touched_at: float, data: dict = None):
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (user_id, state, data, touched_at) VALUES (?, ?, ?, ?)",
+            (user_id, state, json.dumps(data, ensure_ascii=False) if data else None, touched_at)
+        )
+
+    def _drop(self, sql: str, params) -> list:
+        """Удалить сессии по условию пачками по SESSION_PURGE_BATCH, вернуть их ID"""
+        dropped = []
+        with self._purge_lock:
+            while True:
+                self._purge_conn.execute("BEGIN IMMEDIATE")
+                try:
+                    user_ids = [
+                        user_id for user_id, in
+                        self._purge_conn.execute(f"SELECT user_id FROM ({sql}) LIMIT {SESSION_PURGE_BATCH}", params)
+                    ]
+                    self._purge_conn.executemany("DELETE FROM sessions WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+                    self._purge_conn.execute("COMMIT")
+                except Exception:
+                    self._purge_conn.execute("ROLLBACK")
+                    raise
+                dropped.extend(user_ids)
+                if len(user_ids) < SESSION_PURGE_BATCH:
+                    return dropped
+
+    def _purge(self) -> tuple:
+        expired = self._drop("SELECT user_id FROM sessions WHERE touched_at <= ?", (time.time() - self.ttl,))
+        evicted = self._drop("SELECT user_id FROM sessions ORDER BY touched_at DESC LIMIT -1 OFFSET ?", (self.max_size,))
+        return expired, evicted
+
+    def _release(self, expired: list, evicted: list) -> int:
+        self.expirations += len(expired)
+        self.evictions += len(evicted)
+        for user_id in expired + evicted:
+            if self.on_evict:
+                try:
+                    self.on_evict(user_id)
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка при освобождении сессии {user_id}: {e}")
+        return len(expired)
+
+    def purge_expired(self) -> int:
+        """Удалить просроченные сессии и самые давние сверх max_size"""
+        return self._release(*self._purge())
+
+    async def purge_expired_async(self) -> int:
+        """То же в отдельном потоке; on_evict вызывается в цикле событий"""
+        return self._release(*await asyncio.to_thread(self._purge))
+
+    def stats(self) -> dict:
+        sessions, waiting = self._execute("SELECT COUNT(*), COUNT(state) FROM sessions")[0]
+        return {
+            "backend": "shared",
+            "path": self.path,
+            "sessions": sessions,
+            "waiting": waiting,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "busy": self.busy,
+            "ttl_seconds": self.ttl,
+            "max_size": self.max_size
+        }
+
+# Состояния пользователя
+if SESSION_BACKEND == "shared":
+    USER_STATES = SharedSessionStore(SESSION_SHARED_DB, SESSION_TTL, SESSION_MAX_USERS)
+else:
+    USER_STATES = SessionStore(SESSION_TTL, SESSION_MAX_USERS)
+
+class SQLitePersistence(BasePersistence):
+    """Хранение user_data и состояний воронки в SQLite через persistence API PTB.
+
+    Application сам вызывает update_user_data раз в SESSION_FLUSH_INTERVAL секунд
+    для пользователей с активностью; запись в базу идет в отдельном потоке.
+    """
+
+    def __init__(self, path: str, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._connect()
+
+    def _connect(self):
+        """Открыть базу (и после close(): PTB может вызвать flush и update_* повторно)"""
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, state TEXT, updated_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "session_data" not in columns:
+            # База из версии без данных сессии
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN session_data TEXT")
+        self._conn.commit()
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            if self._conn is None:
+                self._connect()
+            rows = self._conn.execute(sql, params).fetchall()
+            self._conn.commit()
+            return rows
+
+    async def get_user_data(self) -> dict:
+        deadline = time.time() - USER_STATES.ttl
+        await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE updated_at <= ?", (deadline,))
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT user_id, data, state, updated_at, session_data FROM sessions ORDER BY updated_at"
+        )
+        user_data = {}
+        for user_id, data, state, updated_at, session_data in rows:
+            user_data[user_id] = json.loads(data)
+            USER_STATES.restore(
+                user_id, FUNNEL.parse_state(state), updated_at, json.loads(session_data) if session_data else None
+            )
+        logger.info(f"💾 Восстановлено сессий из {self.path}: {len(user_data)}")
+        return user_data
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        session_data = USER_STATES.get_data(user_id)
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO sessions (user_id, data, state, updated_at, session_data) VALUES (?, ?, ?, ?, ?)",
+            (
+                user_id,
+                json.dumps(data, ensure_ascii=False, default=str),
+                USER_STATES.peek(user_id),
+                time.time(),
+                json.dumps(session_data, ensure_ascii=False) if session_data else None
+            )
+        )
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await asyncio.to_thread(self._execute, "DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+    def close(self):
+        """Закрытие базы при остановке (см. post_shutdown)"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Продление сессии пользователя при любом обновлении"""
+    STARTUP.mark("first_update")
+    if update.effective_user:
+        USER_STATES.touch(update.effective_user.id)
+
+async def purge_sessions_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая очистка просроченных сессий"""
+    if isinstance(USER_STATES, SharedSessionStore):
+        purged = await USER_STATES.purge_expired_async()
+    else:
+        purged = USER_STATES.purge_expired()
+    if purged:
+        logger.info(f"🧹 Удалено просроченных сессий: {purged}")
+
+# === ВОРОНКА (КОНЕЧНЫЙ АВТОМАТ) ===
+IDLE = "idle"  # состояние по умолчанию, в USER_STATES хранится как None
+ANY = "*"      # переход из любого состояния
+STAY = None    # переход без смены состояния
+
+Transition = collections.namedtuple("Transition", "handler target guard")
+
+class FunnelMachine:
+    """Воронка как конечный автомат.
+
+    Переходы описываются один раз списком (состояние, событие, обработчик,
+    новое состояние[, условие]) и компилируются в словарь
+    (состояние, источник, событие) -> переходы. Поиск перехода - не больше
+    четырех обращений к словарю при любом числе шагов: точное событие в
+    текущем состоянии, общее событие ("text", "command", "callback") в
+    текущем состоянии, затем то же для ANY.
+
+    События сообщений (команды "/...", события ключевых слов, "text",
+    "command") и события кнопок (все остальные) не пересекаются: текст
+    "tariffs" не вызовет обработчик кнопки, а callback_data "/start" -
+    обработчик команды.
+
+    Состояние пользователя - строка в USER_STATES, поэтому оно как есть
+    сохраняется в SQLite и в снимках.
+    """
+
+    def __init__(self, states, transitions, keywords=None, store=None):
+        self.states = frozenset(states) | {IDLE}
+        self.store = store
+        self.keywords = tuple((keywords or {}).items())
+        keyword_events = {event for _, event in self.keywords}
+
+        table = {}
+        for source, event, handler, target, *guard in transitions:
+            if source != ANY and source not in self.states:
+                raise ValueError(f"Неизвестное состояние {source} в переходе по {event}")
+            if target is not STAY and target not in self.states:
+                raise ValueError(f"Неизвестное состояние {target} в переходе по {event}")
+            origin = "message" if event.startswith("/") or event in keyword_events or event in ("text", "command") else "callback"
+            table.setdefault((source, origin, event), []).append(Transition(handler, target, guard[0] if guard else None))
+
+        self.table = types.MappingProxyType({key: tuple(items) for key, items in table.items()})
+        self.message_events = frozenset(event for _, origin, event in table if origin == "message")
+        self.callback_events = frozenset(event for _, origin, event in table if origin == "callback")
+        self.commands = sorted(event[1:] for event in self.message_events if event.startswith("/"))
+        self.dispatched = collections.Counter()
+        self.unhandled = 0
+
+    # --- события ---
+
+    def callback_event(self, data: str) -> str:
+        """'reviews_page_2' -> 'reviews_page_*', если точного события нет"""
+        if data in self.callback_events:
+            return data
+        return data.rstrip("0123456789") + "*"
+
+    def message_event(self, message) -> tuple:
+        """(событие, общее событие) для текстового сообщения или команды"""
+        text = (message.text or "").lower()
+        entities = message.entities or ()
+        if entities and entities[0].type == "bot_command" and entities[0].offset == 0:
+            return text.split()[0].split("@")[0], "command"
+        if text in self.message_events:
+            return text, "text"
+        for keyword, event in self.keywords:
+            if keyword in text:
+                return event, "text"
+        return "text", "text"
+
+    # --- состояние ---
+
+    def state(self, user_id) -> str:
+        return self.store.get(user_id) or IDLE
+
+    def set_state(self, user_id, state: str):
+        if state == IDLE:
+            self.store.pop(user_id, None)
+        else:
+            self.store[user_id] = state
+
+    def parse_state(self, value):
+        """Состояние из хранилища или снимка; неизвестные (удаленные шаги) сбрасываются"""
+        return value if value in self.states and value != IDLE else None
+
+    # --- переходы ---
+
+    def resolve(self, state: str, event: str, kind: str, update, context):
+        origin = "callback" if kind == "callback" else "message"
+        for key in ((state, origin, event), (state, origin, kind), (ANY, origin, event), (ANY, origin, kind)):
+            for transition in self.table.get(key, ()):
+                if transition.guard is None or transition.guard(update, context):
+                    return transition
+        return None
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, event: str, kind: str) -> bool:
+        """Выполнить переход по событию. False - если перехода нет"""
+        user_id = update.effective_user.id
+        state = self.state(user_id)
+        transition = self.resolve(state, event, kind, update, context)
+        if transition is None:
+            self.unhandled += 1
+            return False
+
+        self.dispatched[transition.handler.__name__] += 1
+        await transition.handler(update, context)
+        # Состояние меняется только после успешной обработки
+        if transition.target is not STAY and transition.target != state:
+            self.set_state(user_id, transition.target)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "states": len(self.states),
+            "transitions": sum(len(items) for items in self.table.values()),
+            "dispatched": sum(self.dispatched.values()),
+            "unhandled": self.unhandled
+        }
+
+# === МЕТРИКИ PROMETHEUS ===
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Counter:
+    """Счетчик Prometheus с одной меткой"""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = collections.defaultdict(int)
+
+    def inc(self, label_value: str, amount: int = 1):
+        self.values[label_value] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in list(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return lines
+
+class Histogram:
+    """Гистограмма длительностей Prometheus с одной меткой.
+
+    observe() только увеличивает счетчик корзины (bisect по границам),
+    накопительные значения считаются при выдаче /metrics.
+    """
+
+    def __init__(self, name: str, help_text: str, label: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # метка -> [счетчики корзин..., +Inf, сумма]
+
+    def observe(self, label_value: str, seconds: float):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, series in list(self.series.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return lines
+
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Время работы обработчиков", "handler")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках", "handler")
+HANDLER_API_CALLS = Histogram(
+    "bot_handler_api_calls", "Запросы к Bot API за один вызов обработчика", "handler",
+    buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+)
+API_LATENCY = Histogram("telegram_api_duration_seconds", "Время запросов к Bot API", "method")
+API_REQUESTS = Counter("telegram_api_requests_total", "Запросы к Bot API", "method")
+API_ERRORS = Counter("telegram_api_errors_total", "Ошибки запросов к Bot API", "method")
+SHEETS_LATENCY = Histogram("sheets_operation_duration_seconds", "Время операций с Google Sheets", "operation")
+SHEETS_ERRORS = Counter("sheets_operation_errors_total", "Ошибки операций с Google Sheets", "operation")
+
+# Ссылка на запущенное приложение (заполняется в post_init)
+APPLICATION = None
+
+# Счетчики запросов к Bot API вложенных обработчиков текущего обновления
+API_CALL_COUNTERS = contextvars.ContextVar("api_call_counters", default=())
+
+def timed_handler(func):
+    """Декоратор: время выполнения и ошибки обработчика в метриках"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        api_calls = [0]
+        token = API_CALL_COUNTERS.set(API_CALL_COUNTERS.get() + (api_calls,))
+        try:
+            with TRACER.span(f"handler:{name}"):
+                return await func(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            API_CALL_COUNTERS.reset(token)
+            HANDLER_LATENCY.observe(name, time.perf_counter() - started)
+            HANDLER_API_CALLS.observe(name, api_calls[0])
+
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который учитывает каждый запрос к Bot API в метриках"""
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        API_REQUESTS.inc(api_method)
+        for api_calls in API_CALL_COUNTERS.get():
+            api_calls[0] += 1
+        try:
+            with TRACER.span(f"api:{api_method}"):
+                code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            API_ERRORS.inc(api_method)
+            raise
+        finally:
+            API_LATENCY.observe(api_method, time.perf_counter() - started)
+        if code >= 400:
+            API_ERRORS.inc(api_method)
+        return code, payload
+
+async def run_sheets_call(operation: str, func, *args):
+    """Вызов gspread в отдельном потоке с учетом времени в метриках"""
+    started = time.perf_counter()
+    try:
+        with TRACER.span(f"sheets:{operation}"):
+            return await asyncio.to_thread(func, *args)
+    except Exception:
+        SHEETS_ERRORS.inc(operation)
+        raise
+    finally:
+        SHEETS_LATENCY.observe(operation, time.perf_counter() - started)
+
+def render_metrics() -> bytes:
+    """Все метрики в текстовом формате Prometheus"""
+    update_queue = APPLICATION.update_queue.qsize() if APPLICATION else 0
+    lines = [
+        "# HELP bot_uptime_seconds Время работы процесса",
+        "# TYPE bot_uptime_seconds gauge",
+        f"bot_uptime_seconds {time.time() - start_time:.0f}",
+        "# HELP bot_update_queue_depth Необработанные обновления в очереди",
+        "# TYPE bot_update_queue_depth gauge",
+        f"bot_update_queue_depth {update_queue}",
+        "# HELP sheets_writer_queue_depth Заявки в outbox, еще не записанные в Google Sheets",
+        "# TYPE sheets_writer_queue_depth gauge",
+        f"sheets_writer_queue_depth {SHEETS_WRITER.depth}",
+        "# HELP bot_sessions Сессии пользователей в памяти",
+        "# TYPE bot_sessions gauge",
+        f"bot_sessions {len(USER_STATES)}",
+        "# HELP process_resident_memory_bytes Занятая процессом память (RSS)",
+        "# TYPE process_resident_memory_bytes gauge",
+        f"process_resident_memory_bytes {read_rss()[0]}"
+    ]
+    for metric in (HANDLER_LATENCY, HANDLER_ERRORS, HANDLER_API_CALLS, API_LATENCY, API_REQUESTS, API_ERRORS, SHEETS_LATENCY, SHEETS_ERRORS):
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+# === ТРАССИРОВКА ОБНОВЛЕНИЙ ===
+# Доля обновлений, для которых собирается дерево спанов (обработчик, каждый вызов Bot API и Sheets)
+TRACE_SAMPLE_RATE = min(1.0, max(0.0, float(os.environ.get("TRACE_SAMPLE_RATE", 0.05))))
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", 3))  # 0 - не писать медленные обновления
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 200))
+TRACE_SLOW_BUFFER_SIZE = 50
+TRACE_MAX_SPANS = 500  # спанов на одну трассу (защита от циклов отправки)
+TRACE_MIN_WAIT = 0.001  # ожидания короче этого не записываются
+
+class Span:
+    """Участок обработки обновления; время по time.perf_counter (монотонные часы)"""
+
+    __slots__ = ("name", "started", "finished", "children", "error", "root")
+
+    def __init__(self, name: str, root=None, started: float = None):
+        self.name = name
+        self.started = time.perf_counter() if started is None else started
+        self.finished = None
+        self.children = []
+        self.error = None
+        self.root = root or self
+
+    def to_dict(self, origin: float) -> dict:
+        data = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 2),
+            "duration_ms": round(((self.finished or time.perf_counter()) - self.started) * 1000, 2)
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+    def render(self, origin: float, depth: int = 0) -> list:
+        """Дерево спанов текстом для лога"""
+        duration = ((self.finished or time.perf_counter()) - self.started) * 1000
+        line = f"{'  ' * depth}{self.name} +{(self.started - origin) * 1000:.0f}мс {duration:.0f}мс"
+        lines = [line + (f" ❌ {self.error}" if self.error else "")]
+        for child in self.children:
+            lines.extend(child.render(origin, depth + 1))
+        return lines
+
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+slow_logger = logging.getLogger(f"{__name__}.slow")
+
+class Tracer:
+    """Трассы обновлений: кольцевой буфер последних и отдельный буфер медленных.
+
+    Спаны собираются только для доли TRACE_SAMPLE_RATE обновлений; для
+    остальных измеряется лишь общее время, и в лог медленных попадает
+    обновление без дерева.
+    """
+
+    def __init__(self, sample_rate: float, slow_seconds: float, buffer_size: int, slow_buffer_size: int):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.recent = collections.deque(maxlen=buffer_size)
+        self.slow = collections.deque(maxlen=slow_buffer_size)
+        self.traced = 0
+        self.sampled = 0
+        self.slow_count = 0
+        self._spans = {}  # id(корень) -> число спанов в трассе
+
+    @contextlib.contextmanager
+    def trace(self, name: str, **attrs):
+        """Корневой спан: обновление или фоновая операция"""
+        started = time.perf_counter()
+        root = Span(name, started=started) if self.sample_rate and random.random() < self.sample_rate else None
+        token = CURRENT_SPAN.set(root)
+        error = None
+        try:
+            yield root
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            self._finish(name, attrs, started, root, error)
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        """Вложенный спан; вне выбранной трассы ничего не делает"""
+        parent = CURRENT_SPAN.get()
+        if parent is None or not self._reserve(parent.root):
+            yield None
+            return
+        span = Span(name, parent.root)
+        parent.children.append(span)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.finished = time.perf_counter()
+            CURRENT_SPAN.reset(token)
+
+    def record(self, name: str, started: float):
+        """Завершенный спан от started до текущего момента (ожидание в очереди, лимите)"""
+        parent = CURRENT_SPAN.get()
+        now = time.perf_counter()
+        if parent is None or now - started < TRACE_MIN_WAIT or not self._reserve(parent.root):
+            return
+        span = Span(name, parent.root, started)
+        span.finished = now
+        parent.children.append(span)
+
+    def _reserve(self, root: Span) -> bool:
+        # Фоновые задачи наследуют контекст обработчика и могут пережить его трассу
+        if root.finished is not None:
+            return False
+        count = self._spans.get(id(root), 0)
+        if count >= TRACE_MAX_SPANS:
+            return False
+        self._spans[id(root)] = count + 1
+        return True
+
+    def _finish(self, name: str, attrs: dict, started: float, root: Span, error: str):
+        duration = time.perf_counter() - started
+        self.traced += 1
+        record = {
+            "name": name,
+            "at": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "duration_ms": round(duration * 1000, 1),
+            **attrs
+        }
+        if error:
+            record["error"] = error
+        if root:
+            root.finished = started + duration
+            root.error = error
+            self._spans.pop(id(root), None)
+            self.sampled += 1
+            record["spans"] = root.to_dict(started)
+            self.recent.append(record)
+        if self.slow_seconds and duration >= self.slow_seconds:
+            self.slow_count += 1
+            self.slow.append(record)
+            details = " ".join(f"{key}={value}" for key, value in attrs.items())
+            tree = "\n".join(root.render(started)) if root else "(спаны не собраны: обновление не попало в выборку)"
+            slow_logger.warning(f"🐢 Медленное {name} {details}: {duration:.2f} сек\n{tree}", extra={"trace": record})
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_seconds": self.slow_seconds,
+            "traced": self.traced,
+            "sampled": self.sampled,
+            "slow": self.slow_count
+        }
+
+TRACER = Tracer(TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS, TRACE_BUFFER_SIZE, TRACE_SLOW_BUFFER_SIZE)
+
+def describe_update(update) -> dict:
+    """Что за обновление - без текста сообщений (в нем могут быть email)"""
+    if not isinstance(update, Update):
+        return {"kind": type(update).__name__}
+    info = {"update_id": update.update_id}
+    if update.effective_user:
+        info["user_id"] = update.effective_user.id
+    if update.callback_query:
+        info["kind"] = f"callback:{update.callback_query.data}"
+    elif update.message and update.message.text and update.message.text.startswith('/'):
+        info["kind"] = update.message.text.split()[0][:32]
+    elif update.message:
+        info["kind"] = "message"
+    else:
+        info["kind"] = "other"
+    return info
+
+# === ОГРАНИЧЕНИЕ ЧАСТОТЫ ИСХОДЯЩИХ СООБЩЕНИЙ ===
+RATE_GLOBAL_PER_SECOND = float(os.environ.get("RATE_GLOBAL_PER_SECOND", 25))  # лимит Telegram ~30 сообщений/сек
+# Лимит на бота целиком делится между процессами-шардами поровну
+RATE_SHARD_PER_SECOND = RATE_GLOBAL_PER_SECOND / BOT_WORKERS if SHARDED else RATE_GLOBAL_PER_SECOND
+RATE_CHAT_PER_SECOND = float(os.environ.get("RATE_CHAT_PER_SECOND", 1))
+RATE_CHAT_BURST = int(os.environ.get("RATE_CHAT_BURST", 3))
+RATE_GROUP_PER_MINUTE = 20
+RATE_MAX_RETRIES = 3
+
+# Приоритеты отправки (передаются через rate_limit_args методов бота)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Забрать токен. Возвращает 0 или сколько секунд ждать до следующей попытки"""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+class ChatQueue:
+    """Очередь отправки в один чат: FIFO-блокировка и своя корзина токенов"""
+
+    def __init__(self, chat_id):
+        self.lock = asyncio.Lock()
+        if isinstance(chat_id, int) and chat_id < 0:
+            self.bucket = TokenBucket(RATE_GROUP_PER_MINUTE / 60, 1)
+        else:
+            self.bucket = TokenBucket(RATE_CHAT_PER_SECOND, RATE_CHAT_BURST)
+        self.users = 0
+
+class OutboundScheduler(BaseRateLimiter):
+    """Планировщик исходящих запросов к Bot API.
+
+    Соблюдает лимиты Telegram на чат и на бота целиком, сохраняет порядок
+    сообщений внутри чата, пропускает интерактивные ответы раньше массовых
+    рассылок (rate_limit_args=PRIORITY_BULK) и сам повторяет запрос после RetryAfter.
+    """
+
+    MAX_IDLE_CHATS = 1000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_SHARD_PER_SECOND, max(1.0, RATE_SHARD_PER_SECOND))
+        self.chats = {}
+        self.interactive_waiting = 0
+        self.throttled = 0
+        self.retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self.chats.clear()
+
+    def _chat(self, chat_id) -> ChatQueue:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            if len(self.chats) >= self.MAX_IDLE_CHATS:
+                self._prune()
+            chat = self.chats[chat_id] = ChatQueue(chat_id)
+        return chat
+
+    def _prune(self):
+        """Удалить простаивающие чаты с полной корзиной"""
+        for chat_id in [key for key, chat in self.chats.items() if not chat.users and chat.bucket.full]:
+            del self.chats[chat_id]
+
+    async def _wait_bucket(self, bucket: TokenBucket):
+        while True:
+            delay = bucket.reserve()
+            if not delay:
+                return
+            self.throttled += 1
+            await asyncio.sleep(delay)
+
+    async def _wait_global(self, priority: int):
+        if priority != PRIORITY_BULK:
+            self.interactive_waiting += 1
+            try:
+                await self._wait_bucket(self.global_bucket)
+            finally:
+                self.interactive_waiting -= 1
+            return
+
+        # Массовые отправки уступают очередь интерактивным
+        while True:
+            if self.interactive_waiting:
+                await asyncio.sleep(1 / self.global_bucket.rate)
+                continue
+            delay = self.global_bucket.reserve()
+            if not delay:
+                return
+            self.throttled += 1
+            await asyncio.sleep(delay)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if rate_limit_args is not None else PRIORITY_INTERACTIVE
+        chat = self._chat(chat_id)
+        chat.users += 1
+        queued = time.perf_counter()
+        try:
+            async with chat.lock:
+                for attempt in range(RATE_MAX_RETRIES + 1):
+                    await self._wait_bucket(chat.bucket)
+                    await self._wait_global(priority)
+                    TRACER.record(f"rate_limit:{endpoint}", queued)
+                    try:
+                        return await callback(*args, **kwargs)
+                    except RetryAfter as e:
+                        if attempt == RATE_MAX_RETRIES:
+                            raise
+                        self.retries += 1
+                        logger.warning(f"⚠️ Flood limit для чата {chat_id} ({endpoint}), повтор через {e.retry_after} сек")
+                        await asyncio.sleep(e.retry_after)
+                        queued = time.perf_counter()
+        finally:
+            chat.users -= 1
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.chats),
+            "throttled": self.throttled,
+            "retry_after": self.retries,
+            "interactive_waiting": self.interactive_waiting
+        }
+
+OUTBOUND = OutboundScheduler()
+
+# === ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ===
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 16))
+UPDATE_MAX_PENDING = UPDATE_WORKERS * 8  # обновлений в работе и в ожидании одновременно
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются одновременно (не больше
+    UPDATE_WORKERS), обновления одного пользователя - строго по очереди, чтобы
+    переходы USER_STATES и context.user_data (выбор тарифа -> email) не перемешивались.
+    Ожидающие своей очереди обновления не занимают рабочие слоты.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        super().__init__(max_pending)
+        self.workers = workers
+        self._worker_slots = asyncio.BoundedSemaphore(workers)
+        self._users = {}  # user_id -> [блокировка, число обновлений в работе]
+        self.active = 0
+        self.processed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update, coroutine) -> None:
+        with TRACER.trace("update", **describe_update(update)):
+            await self._process(update, coroutine)
+
+    async def _process(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        chat = update.effective_chat if isinstance(update, Update) else None
+        key = user.id if user else (chat.id if chat else None)
+        queued = time.perf_counter()
+        if key is None:
+            async with self._worker_slots:
+                TRACER.record("queue_wait", queued)
+                await coroutine
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._worker_slots:
+                    TRACER.record("queue_wait", queued)
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "active": self.active,
+            "users_in_progress": len(self._users),
+            "processed": self.processed
+        }
+
+UPDATE_PROCESSOR = PerUserUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING)
+
 # === УЛУЧШЕННЫЙ ВЕБ-СЕРВЕР ДЛЯ HEALTH CHECK ===
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health' or self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            html = """
+STATUS_REFRESH_INTERVAL = float(os.environ.get("STATUS_REFRESH_INTERVAL", 5))  # секунд
+
+# Статичные части страницы /health собираются один раз
+HEALTH_PAGE_HEAD = """
             <html>
             <head>
                 <title>POLINAFIT Bot</title>
                 <meta name="viewport" content="width=device-width, initial-scale=1">
                 <style>
-                    body {{ font-family: Arial, sans-serif; text-align: center; padding: 50px; }}
-                    h1 {{ color: #4CAF50; }}
-                    .status {{ background: #f0f0f0; padding: 20px; border-radius: 10px; display: inline-block; }}
+                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
+                    h1 { color: #4CAF50; }
+                    .status { background: #f0f0f0; padding: 20px; border-radius: 10px; display: inline-block; }
                 </style>
                 <meta http-equiv="refresh" content="300">
             </head>
@@ -61,57 +1477,381 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
                 <div class="status">
                     <h1>🤖 POLINAFIT Bot</h1>
                     <p>Status: <strong style="color: green;">✅ Online</strong></p>
-                    <p>Uptime: {} seconds</p>
-                    <p>Last check: {}</p>
-                    <p>Users in memory: {}</p>
+""".encode('utf-8')
+
+HEALTH_PAGE_TAIL = """
                 </div>
             </body>
             </html>
-            """.format(
-                int(time.time() - start_time),
-                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                len(USER_STATES)
-            )
-            self.wfile.write(html.encode('utf-8'))
-        elif self.path == '/ping' or self.path == '/keepalive':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'pong')
-        elif self.path == '/status':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            status = {
-                "status": "online",
-                "timestamp": datetime.datetime.now().isoformat(),
-                "uptime_seconds": int(time.time() - start_time),
-                "users_in_memory": len(USER_STATES),
-                "bot": "POLINAFIT Fitness Bot"
-            }
-            self.wfile.write(json.dumps(status).encode('utf-8'))
+""".encode('utf-8')
+
+def render_health_page() -> bytes:
+    """HTML-страница /health: подставляются только изменяемые строки"""
+    body = (
+        f"                    <p>Uptime: {int(time.time() - start_time)} seconds</p>\n"
+        f"                    <p>Last check: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>\n"
+        f"                    <p>Users in memory: {len(USER_STATES)}</p>"
+    )
+    return HEALTH_PAGE_HEAD + body.encode('utf-8') + HEALTH_PAGE_TAIL
+
+def build_status() -> dict:
+    """Данные для /status"""
+    return {
+        "status": "online",
+        "timestamp": datetime.datetime.now().isoformat(),
+        "uptime_seconds": int(time.time() - start_time),
+        "mode": "webhook" if USE_WEBHOOK else "polling",
+        "users_in_memory": len(USER_STATES),
+        "sessions": USER_STATES.stats(),
+        "funnel": FUNNEL.stats(),
+        "logging": logging_stats(),
+        "sheets_writer": SHEETS_WRITER.stats(),
+        "content": CONTENT.stats(),
+        "media_cache": MEDIA.stats(),
+        "outbound": OUTBOUND.stats(),
+        "navigation": {"mode": NAVIGATION_MODE, **NAVIGATION_STATS},
+        "send_buffer": dict(SEND_BUFFER_STATS),
+        "updates": UPDATE_PROCESSOR.stats(),
+        "tracing": TRACER.stats(),
+        "customers": STATS.snapshot(),
+        "customer_index": CUSTOMERS.stats(),
+        "broadcast": BROADCASTER.stats(),
+        "sheets": SHEETS_STATE,
+        "shard": shard_stats(),
+        "snapshot": SNAPSHOT_INFO,
+        "startup": STARTUP.snapshot(),
+        "bot": "POLINAFIT Fitness Bot"
+    }
+
+# Готовый JSON для /status, обновляется по таймеру (см. refresh_status_snapshot)
+STATUS_SNAPSHOT = b'{"status": "starting"}'
+
+def update_status_snapshot():
+    global STATUS_SNAPSHOT
+    STATUS_SNAPSHOT = json.dumps(build_status()).encode('utf-8')
+
+async def refresh_status_snapshot():
+    """Периодическое обновление снимка /status"""
+    while True:
+        try:
+            update_status_snapshot()
+        except Exception as e:
+            logger.error(f"Ошибка обновления /status: {e}")
+        await asyncio.sleep(STATUS_REFRESH_INTERVAL)
+
+# === АСИНХРОННЫЙ HTTP-СЕРВЕР (HEALTH CHECK + WEBHOOK) ===
+HTTP_READ_TIMEOUT = 10  # секунд на чтение запроса
+HTTP_MAX_BODY = 1024 * 1024
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable"
+}
+
+class HttpRequest:
+    """Разобранный HTTP-запрос"""
+
+    def __init__(self, method: str, path: str, headers: dict, body: bytes, query: dict = None):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.query = query or {}
+
+async def http_health(request: HttpRequest):
+    return 200, "text/html; charset=utf-8", render_health_page()
+
+async def http_ping(request: HttpRequest):
+    return 200, "text/plain", b'pong'
+
+async def http_status(request: HttpRequest):
+    return 200, "application/json", STATUS_SNAPSHOT
+
+async def http_metrics(request: HttpRequest):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render_metrics()
+
+# (метод, путь) -> обработчик, возвращающий (код, content-type, тело)
+HTTP_ROUTES = {
+    ("GET", "/"): http_health,
+    ("GET", "/health"): http_health,
+    ("GET", "/ping"): http_ping,
+    ("GET", "/keepalive"): http_ping,
+    ("GET", "/status"): http_status,
+    ("GET", "/metrics"): http_metrics
+}
+
+class PayloadTooLarge(ValueError):
+    """Тело запроса больше HTTP_MAX_BODY"""
+
+async def read_http_request(reader: asyncio.StreamReader):
+    """Чтение одного HTTP-запроса. None - если клиент закрыл соединение"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length') or 0)
+    if length > HTTP_MAX_BODY:
+        raise PayloadTooLarge(length)
+    body = await reader.readexactly(length) if length else b''
+    path, _, query = target.partition('?')
+    return HttpRequest(method.upper(), path, headers, body, dict(urllib.parse.parse_qsl(query)))
+
+async def handle_http_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Обработка одного соединения (ответ и закрытие)"""
+    try:
+        try:
+            request = await asyncio.wait_for(read_http_request(reader), timeout=HTTP_READ_TIMEOUT)
+        except PayloadTooLarge:
+            request, response = None, (413, "text/plain", b'payload too large')
+        except ValueError:
+            request, response = None, (400, "text/plain", b'bad request')
         else:
-            self.send_response(404)
-            self.end_headers()
-    
-    def log_message(self, format, *args):
-        pass  # Отключаем логирование для уменьшения шума
+            if request is None:
+                return
+            route = HTTP_ROUTES.get((request.method, request.path))
+            if route is None and request.method == "HEAD":
+                route = HTTP_ROUTES.get(("GET", request.path))
+            try:
+                response = await route(request) if route else (404, "text/plain", b'not found')
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике {request.method} {request.path}: {e}", exc_info=True)
+                response = (500, "text/plain", b'internal server error')
+
+        status, content_type, body = response
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('latin-1')
+        writer.write(head if request and request.method == "HEAD" else head + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка обработки HTTP-запроса: {e}")
+    finally:
+        writer.close()
+
+HTTP_SERVER = None
+STATUS_TASK = None
+
+async def start_http_server():
+    """Запуск асинхронного HTTP-сервера на PORT в текущем event loop"""
+    global HTTP_SERVER, STATUS_TASK
+    if HTTP_SERVER:
+        return HTTP_SERVER
+    update_status_snapshot()
+    STATUS_TASK = asyncio.create_task(refresh_status_snapshot())
+    HTTP_SERVER = await asyncio.start_server(handle_http_connection, "0.0.0.0", PORT)
+    logger.info(f"🚀 Веб-сервер запущен на порту {PORT}")
+    logger.info(f"🌐 Health check: http://0.0.0.0:{PORT}/health")
+    logger.info(f"📊 Status JSON: http://0.0.0.0:{PORT}/status")
+    logger.info(f"🏓 Ping: http://0.0.0.0:{PORT}/ping")
+    return HTTP_SERVER
+
+async def stop_http_server():
+    """Остановка HTTP-сервера и обновления /status"""
+    global HTTP_SERVER, STATUS_TASK
+    if STATUS_TASK:
+        STATUS_TASK.cancel()
+        STATUS_TASK = None
+    if HTTP_SERVER:
+        HTTP_SERVER.close()
+        await HTTP_SERVER.wait_closed()
+        HTTP_SERVER = None
+
+# === ДИАГНОСТИКА ПАМЯТИ (/debug/memory) ===
+# Без DEBUG_TOKEN эндпоинт выключен; запрос: Authorization: Bearer <DEBUG_TOKEN>
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN", "")
+TRACEMALLOC_FRAMES = int(os.environ.get("TRACEMALLOC_FRAMES", 1))  # трассировку с запуска включает PYTHONTRACEMALLOC=N
+MEMORY_TOP_LIMIT = 25
+MEMORY_SIZE_LIMIT = 200000  # объектов на одну структуру при подсчете размера
+
+TRACE_BASELINE = None  # (время, снимок tracemalloc) для сравнения
+
+def read_rss() -> tuple:
+    """(текущий RSS, пиковый RSS) в байтах"""
+    rss = peak = 0
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return rss, peak
+
+def deep_sizeof(root, limit: int = MEMORY_SIZE_LIMIT) -> tuple:
+    """Приблизительный размер структуры с вложенными объектами: (байт, объектов, обход полный)"""
+    seen = set()
+    stack = [root]
+    total = 0
+    while stack:
+        if len(seen) >= limit:
+            return total, len(seen), False
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj, 0)
+        # Внутрь произвольных объектов не заходим: через asyncio.Lock и т.п. обход дошел бы до всего процесса
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(obj)
+    return total, len(seen), True
+
+def structure_sizes() -> dict:
+    """Размеры основных структур процесса"""
+    structures = {
+        "sessions": USER_STATES._data if isinstance(USER_STATES, SessionStore) else None,
+        "ptb_user_data": APPLICATION.user_data if APPLICATION else None,
+        "ptb_chat_data": APPLICATION.chat_data if APPLICATION else None,
+        "sheets_writer_pending": SHEETS_WRITER.pending,
+        "customer_index": CUSTOMERS.rows,
+        "stats_index": STATS.customers,
+        "outbound_chats": OUTBOUND.chats,
+        "update_processor_users": UPDATE_PROCESSOR._users,
+        "media_cache": MEDIA.file_ids,
+        "content": CONTENT.__dict__,
+    }
+    sizes = {}
+    for name, value in structures.items():
+        if value is None:
+            continue
+        size, objects, complete = deep_sizeof(value)
+        sizes[name] = {"items": len(value), "bytes": size, "objects": objects, "complete": complete}
+    if not isinstance(USER_STATES, SessionStore):
+        sizes["sessions"] = {"items": len(USER_STATES), "backend": "shared"}
+    return sizes
+
+def queue_depths() -> dict:
+    return {
+        "update_queue": APPLICATION.update_queue.qsize() if APPLICATION else 0,
+        "log_queue": LOG_HANDLER.queue.qsize(),
+        "sheets_writer": SHEETS_WRITER.depth,
+        "broadcast_pending": BROADCASTER.counts["pending"] if BROADCASTER.running else 0,
+        "background_tasks": len(BACKGROUND_TASKS),
+        "asyncio_tasks": len(asyncio.all_tasks())
+    }
+
+def allocation_stats(stats: list, limit: int) -> list:
+    return [
+        {
+            "site": str(stat.traceback[0]) if stat.traceback else "?",
+            "size_bytes": stat.size,
+            "count": stat.count,
+            **({"size_diff_bytes": stat.size_diff, "count_diff": stat.count_diff} if hasattr(stat, "size_diff") else {})
+        }
+        for stat in stats[:limit]
+    ]
+
+def trace_report(limit: int, diff: bool) -> dict:
+    """Топ мест выделения памяти и разница с базовым снимком (в потоке, снимок делается долго)"""
+    if not tracemalloc.is_tracing():
+        return {"tracing": False}
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    report = {
+        "tracing": True,
+        "frames": tracemalloc.get_traceback_limit(),
+        "traced_bytes": current,
+        "traced_peak_bytes": peak,
+        "overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+        "top": allocation_stats(snapshot.statistics("lineno"), limit)
+    }
+    if diff and TRACE_BASELINE:
+        taken_at, baseline = TRACE_BASELINE
+        report["baseline_age_seconds"] = round(time.time() - taken_at, 1)
+        report["diff"] = allocation_stats(snapshot.compare_to(baseline, "lineno"), limit)
+    return report
+
+def memory_action(action: str) -> str:
+    """start | stop | baseline - управление tracemalloc без перезапуска"""
+    global TRACE_BASELINE
+    if action == "start":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        return "tracing"
+    if action == "stop":
+        tracemalloc.stop()
+        TRACE_BASELINE = None
+        return "stopped"
+    if action == "baseline":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        TRACE_BASELINE = (time.time(), tracemalloc.take_snapshot())
+        return "baseline saved"
+    raise ValueError(f"unknown action: {action}")
+
+def debug_authorized(request: HttpRequest) -> bool:
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(supplied.encode(), DEBUG_TOKEN.encode())
+
+async def http_debug_memory(request: HttpRequest):
+    """GET - отчет (?limit=N, ?diff=1), POST ?action=start|stop|baseline"""
+    if not DEBUG_TOKEN:
+        return 404, "text/plain", b'not found'
+    if not debug_authorized(request):
+        logger.warning("⚠️ Запрос к /debug/memory без верного токена")
+        return 403, "text/plain", b'forbidden'
+
+    if request.method == "POST":
+        try:
+            # Снимок tracemalloc собирается долго - не в event loop
+            result = await asyncio.to_thread(memory_action, request.query.get("action", ""))
+        except ValueError as e:
+            return 400, "text/plain", str(e).encode()
+        logger.info(f"🧠 /debug/memory: {result}")
+        return 200, "application/json", json.dumps({"result": result}).encode()
 
-def run_health_server():
-    """Запуск улучшенного health сервера"""
     try:
-        server = HTTPServer(("0.0.0.0", PORT), HealthCheckHandler)
-        logger.info(f"🚀 Веб-сервер запущен на порту {PORT}")
-        logger.info(f"🌐 Health check: http://0.0.0.0:{PORT}/health")
-        logger.info(f"📊 Status JSON: http://0.0.0.0:{PORT}/status")
-        logger.info(f"🏓 Ping: http://0.0.0.0:{PORT}/ping")
-        server.serve_forever()
-    except Exception as e:
-        logger.error(f"Ошибка веб-сервера: {e}")
+        limit = min(200, max(1, int(request.query.get("limit", MEMORY_TOP_LIMIT))))
+    except ValueError:
+        return 400, "text/plain", b'bad limit'
+    rss, rss_peak = read_rss()
+    report = {
+        "rss_bytes": rss,
+        "rss_peak_bytes": rss_peak,
+        "gc": {"counts": gc.get_count(), "tracked_objects": len(gc.get_objects())},
+        "structures": structure_sizes(),
+        "queues": queue_depths(),
+        "tracemalloc": await asyncio.to_thread(trace_report, limit, request.query.get("diff") == "1")
+    }
+    return 200, "application/json", json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8")
+
+HTTP_ROUTES[("GET", "/debug/memory")] = http_debug_memory
+HTTP_ROUTES[("POST", "/debug/memory")] = http_debug_memory
 
-# Запускаем веб-сервер в фоновом потоке с высоким приоритетом
-health_thread = threading.Thread(target=run_health_server, daemon=True)
-health_thread.start()
+async def http_debug_traces(request: HttpRequest):
+    """Последние трассы обновлений; ?slow=1 - только медленные"""
+    if not DEBUG_TOKEN:
+        return 404, "text/plain", b'not found'
+    if not debug_authorized(request):
+        logger.warning("⚠️ Запрос к /debug/traces без верного токена")
+        return 403, "text/plain", b'forbidden'
+    traces = TRACER.slow if request.query.get("slow") == "1" else TRACER.recent
+    report = {"tracing": TRACER.stats(), "traces": list(traces)[::-1]}
+    return 200, "application/json", json.dumps(report, ensure_ascii=False, indent=2).encode("utf-8")
+
+HTTP_ROUTES[("GET", "/debug/traces")] = http_debug_traces
 
 # === ДОПОЛНИТЕЛЬНЫЙ СЕРВИС ДЛЯ ПОДДЕРЖАНИЯ АКТИВНОСТИ ===
 def keep_alive_service():
@@ -134,13 +1874,25 @@ def keep_alive_service():
         # Ждем 4 минуты перед следующим пингом
         time.sleep(240)
 
-# Запускаем keep-alive сервис в отдельном потоке
-keep_alive_thread = threading.Thread(target=keep_alive_service, daemon=True)
-keep_alive_thread.start()
+keep_alive_thread = None
+
+def start_keep_alive():
+    """Запуск keep-alive в отдельном потоке, когда HTTP-сервер уже слушает порт"""
+    global keep_alive_thread
+    if keep_alive_thread is None:
+        keep_alive_thread = threading.Thread(target=keep_alive_service, daemon=True)
+        keep_alive_thread.start()
 
 # === GOOGLE ТАБЛИЦА ===
+SHEETS_BACKEND = os.environ.get("SHEETS_BACKEND", "google")  # google | fake (fake_sheets.py, для тестов)
+
 def init_google_sheets():
     """Инициализация подключения к Google Sheets"""
+    if SHEETS_BACKEND == "fake":
+        from fake_sheets import FakeWorksheet
+        logger.warning("⚠️ Используется локальная имитация Google Sheets (SHEETS_BACKEND=fake)")
+        return FakeWorksheet.from_env()
+    
     try:
         google_creds_json = os.getenv("GOOGLE_CREDS_JSON")
         
@@ -152,20 +1904,18 @@ def init_google_sheets():
                 logger.warning("Файл credentials.json не найден, Google Sheets отключен")
                 return None
         
-        if google_creds_json.startswith('{'):
-            with open("temp_credentials.json", "w", encoding="utf-8") as f:
-                f.write(google_creds_json)
-            creds_file = "temp_credentials.json"
-        else:
-            creds_file = google_creds_json
-        
         SCOPE = [
             "https://spreadsheets.google.com/feeds",
             "https://www.googleapis.com/auth/drive",
             "https://www.googleapis.com/auth/spreadsheets"
         ]
         
-        CREDS = ServiceAccountCredentials.from_json_keyfile_name(creds_file, SCOPE)
+        started = time.perf_counter()
+        # JSON из переменной окружения читается без временного файла на диске
+        if google_creds_json.lstrip().startswith('{'):
+            CREDS = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(google_creds_json), SCOPE)
+        else:
+            CREDS = ServiceAccountCredentials.from_json_keyfile_name(google_creds_json, SCOPE)
         CLIENT = gspread.authorize(CREDS)
         SHEET = CLIENT.open("Клиенты фитнес-бота").sheet1
         
@@ -176,42 +1926,880 @@ def init_google_sheets():
             SHEET.append_row(expected_headers)
             logger.info("Созданы заголовки в таблице")
         
+        SHEETS_LATENCY.observe("init", time.perf_counter() - started)
         logger.info("✅ Успешно подключено к Google Таблице!")
         return SHEET
         
     except Exception as e:
+        SHEETS_ERRORS.inc("init")
         logger.error(f"❌ Ошибка подключения к Google Таблице: {e}")
         return None
 
-SHEET = init_google_sheets()
+# Подключение выполняется в фоне после запуска бота (см. warm_up_sheets),
+# чтобы медленный Google не задерживал первый ответ пользователю
+SHEET = None
+SHEETS_STATE = "pending"  # pending | warming | retrying | ready | disabled (нет учетных данных) | delegated (шард > 0)
+SHEETS_WARMUP_TASK = None
 
-# === ФУНКЦИИ ДЛЯ РАБОТЫ С ДАННЫМИ ===
-def save_to_google_sheets(user_data: dict):
-    """Сохранение данных пользователя в Google Sheets"""
+def sheets_configured() -> bool:
+    """Есть ли учетные данные: без них повторять подключение бессмысленно"""
+    return SHEETS_BACKEND == "fake" or bool(os.getenv("GOOGLE_CREDS_JSON")) or os.path.exists("credentials.json")
+
+async def warm_up_sheets():
+    """Фоновое подключение к таблице (с повторами при ошибках) и загрузка индексов, затем запуск записи очереди"""
+    global SHEET, SHEETS_STATE
+    if not sheets_configured():
+        SHEETS_STATE = "disabled"
+        logger.warning(f"⚠️ Google Sheets не настроен, заявки копятся в outbox (в очереди: {SHEETS_WRITER.depth})")
+        return
+
+    SHEETS_STATE = "warming"
+    attempt = 0
+    while True:
+        with STARTUP.phase("sheets_auth"):
+            sheet = await asyncio.to_thread(init_google_sheets)
+        if sheet:
+            break
+        # Та же экспоненциальная задержка со случайным разбросом, что и у SheetsWriter
+        attempt += 1
+        SHEETS_STATE = "retrying"
+        delay = min(SHEETS_MAX_BACKOFF, SHEETS_FLUSH_INTERVAL * 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+        logger.warning(f"⚠️ Google Sheets недоступен (попытка {attempt}), повтор через ~{delay:.0f} сек, в очереди: {SHEETS_WRITER.depth}")
+        await asyncio.sleep(delay)
+
+    SHEET = sheet
+    # Индексы загружаются параллельно и до первой записи, иначе пачка могла бы попасть в них дважды
+    async def timed(name, load):
+        with STARTUP.phase(name):
+            await load()
+    await asyncio.gather(timed("stats_index", load_stats_index), timed("customer_index", load_customer_index))
+    SHEETS_STATE = "ready"
+    STARTUP.mark("sheets_ready")
+    SHEETS_WRITER.wake()
+
+def start_sheets_warmup():
+    global SHEETS_WARMUP_TASK, SHEETS_STATE
+    if SHARD_ID:
+        # Таблицу читает и пишет только шард 0: остальные кладут заявки в общий outbox,
+        # приветствие повторных клиентов опирается на снимок и заявки своей сессии
+        SHEETS_STATE = "delegated"
+        logger.info("🗂 Google Sheets обслуживает шард 0, подключение пропущено")
+        return
+    if SHEETS_WARMUP_TASK is None:
+        SHEETS_WARMUP_TASK = asyncio.create_task(warm_up_sheets())
+
+# === ФОНОВАЯ ЗАПИСЬ В GOOGLE SHEETS ===
+SHEETS_BATCH_SIZE = int(os.environ.get("SHEETS_BATCH_SIZE", 20))
+SHEETS_FLUSH_INTERVAL = float(os.environ.get("SHEETS_FLUSH_INTERVAL", 5))
+SHEETS_MAX_BACKOFF = float(os.environ.get("SHEETS_MAX_BACKOFF", 300))  # секунд между повторами при ошибках
+# При нескольких шардах outbox общий: заявки всех процессов пишет в таблицу шард 0
+OUTBOX_DB = os.environ.get("OUTBOX_DB", "outbox.sqlite3")
+OUTBOX_DB = OUTBOX_DB if SHARDED else shard_path(OUTBOX_DB)
+OUTBOX_RETENTION = int(os.environ.get("OUTBOX_RETENTION", 7 * 24 * 3600))  # сколько хранить отправленные заявки
+
+class Outbox:
+    """Локальный журнал заявок для Google Sheets (SQLite, запись с fsync).
+
+    Заявка попадает сюда до ответа пользователю и помечается отправленной
+    только после успешной записи в таблицу, поэтому переживает перезапуск
+    процесса и недоступность Google. Ключ идемпотентности не дает записать
+    одну заявку дважды, если Telegram повторно доставит то же обновление.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, data TEXT NOT NULL, "
+            "created_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, sent_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (sent_at, id)")
+        self._conn.commit()
+
+    def add(self, key: str, row: list):
+        """Записать заявку. Возвращает id или None, если заявка с таким ключом уже есть"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, data, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(row, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def pending(self) -> list:
+        """Неотправленные заявки по порядку: [(id, строка), ...]"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, data FROM outbox WHERE sent_at IS NULL ORDER BY id").fetchall()
+        return [(entry_id, json.loads(data)) for entry_id, data in rows]
+
+    def backlog(self) -> int:
+        """Число неотправленных заявок в базе (при шардах - всех процессов)"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM outbox WHERE sent_at IS NULL").fetchone()[0]
+
+    def mark_sent(self, ids: list):
+        """Отметить заявки записанными и удалить старые отправленные"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE outbox SET sent_at = ? WHERE id = ?", [(now, entry_id) for entry_id in ids])
+            self._conn.execute("DELETE FROM outbox WHERE sent_at IS NOT NULL AND sent_at < ?", (now - OUTBOX_RETENTION,))
+            self._conn.commit()
+
+    def mark_failed(self, ids: list, error: str):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(error[:500], entry_id) for entry_id in ids]
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class SheetsWriter:
+    """Очередь отложенной записи строк в Google Sheets.
+
+    Обработчики только кладут строки в очередь (и в локальный Outbox),
+    а фоновая задача отправляет их пачками в отдельном потоке, чтобы
+    медленный ответ Google не блокировал event loop. После ошибки
+    следующая попытка откладывается с экспоненциальным ростом паузы.
+
+    owner=False (дочерний шард): строки только сохраняются в общий outbox,
+    в таблицу их пишет основной процесс, забирая новые заявки при каждом цикле.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, outbox: Outbox, owner: bool = True):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.outbox = outbox
+        self.owner = owner
+        self.pending = collections.deque()  # (id в outbox, строка)
+        self._inflight = set()  # id отправляемой пачки
+        self.rows_written = 0
+        self.rows_replayed = 0
+        self.duplicates = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.consecutive_errors = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._retry_at = 0.0
+        self._wakeup = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    async def enqueue(self, row: list, key: str) -> bool:
+        """Сохранить строку в outbox и поставить в очередь. False - повтор по ключу"""
+        entry_id = await asyncio.to_thread(self.outbox.add, key, row)
+        if entry_id is None:
+            self.duplicates += 1
+            return False
+        if not self.owner:
+            return True
+        self.pending.append((entry_id, row))
+        if self._wakeup and len(self.pending) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def wake(self):
+        """Выгрузить очередь, не дожидаясь интервала"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def start(self):
+        """Запуск фоновой задачи записи на текущем event loop (с заявками, оставшимися в outbox)"""
+        if self._task or not self.owner:
+            return
+        queued = {entry_id for entry_id, _ in self.pending}
+        backlog = [entry for entry in await asyncio.to_thread(self.outbox.pending) if entry[0] not in queued]
+        if backlog:
+            self.pending.extendleft(reversed(backlog))
+            self.rows_replayed += len(backlog)
+            for _, row in backlog:
+                CUSTOMERS.mark_pending(row[0])
+            logger.info(f"📬 Из outbox восстановлено неотправленных заявок: {len(backlog)}")
+
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Фоновая запись в Google Sheets запущена (пачка {self.batch_size}, интервал {self.flush_interval} сек)")
+
+    async def stop(self):
+        """Остановка задачи с финальной выгрузкой очереди"""
+        if self._task:
+            # Не отменяем задачу: текущая пачка должна дописаться и попасть в индекс клиентов
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        while self.pending:
+            if not await self.flush():
+                break
+        if self.pending:
+            logger.warning(f"⚠️ В outbox осталось {len(self.pending)} заявок, они будут отправлены после перезапуска")
+
+    async def _run(self):
+        while not self._stopping:
+            timeout = max(0.0, self._retry_at - time.monotonic()) or self.flush_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if SHARDED:
+                await self.adopt()
+            if time.monotonic() < self._retry_at:
+                continue
+            while self.pending and not self._stopping:
+                with TRACER.trace("sheets_flush", rows=min(self.batch_size, len(self.pending))):
+                    flushed = await self.flush()
+                if not flushed:
+                    break
+
+    async def adopt(self):
+        """Забрать заявки, сохраненные в общий outbox другими шардами"""
+        known = {entry_id for entry_id, _ in self.pending} | self._inflight
+        try:
+            fresh = [entry for entry in await asyncio.to_thread(self.outbox.pending) if entry[0] not in known]
+        except Exception as e:
+            logger.error(f"Ошибка чтения outbox: {e}")
+            return
+        self.pending.extend(fresh)
+        for _, row in fresh:
+            CUSTOMERS.mark_pending(row[0])
+
+    async def flush(self) -> bool:
+        """Отправить одну пачку строк. При ошибке строки возвращаются в очередь.
+
+        Строки уже известных клиентов перезаписываются через batch_update,
+        новые клиенты добавляются через append_rows (он расширяет лист).
+        """
+        if not self.pending or SHEETS_STATE != "ready":
+            return False
+        # Без индекса клиентов нельзя отличить новую строку от повторной
+        if not CUSTOMERS.loaded and not await load_customer_index():
+            return False
+
+        batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+        ids = [entry_id for entry_id, _ in batch]
+        self._inflight = set(ids)
+        updates, appends = CUSTOMERS.plan([row for _, row in batch])
+        started = time.perf_counter()
+        try:
+            if updates:
+                await run_sheets_call("batch_update", SHEET.batch_update, [
+                    {"range": f"A{number}:{gspread.utils.rowcol_to_a1(number, len(row))}", "values": [row]}
+                    for number, row in updates
+                ])
+            response = None
+            if appends:
+                response = await run_sheets_call("append_rows", SHEET.append_rows, appends)
+        except Exception as e:
+            self.pending.extendleft(reversed(batch))
+            self._inflight = set()
+            self.flush_errors += 1
+            self.consecutive_errors += 1
+            delay = min(SHEETS_MAX_BACKOFF, self.flush_interval * 2 ** (self.consecutive_errors - 1))
+            self._retry_at = time.monotonic() + delay * random.uniform(0.8, 1.2)
+            logger.error(f"Ошибка при сохранении в Google Sheets ({len(batch)} строк), повтор через ~{delay:.0f} сек: {e}")
+            try:
+                await asyncio.to_thread(self.outbox.mark_failed, ids, str(e))
+            except Exception as outbox_error:
+                logger.error(f"Ошибка записи в outbox: {outbox_error}")
+            return False
+        finally:
+            self.last_flush_latency = time.perf_counter() - started
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+
+        self.consecutive_errors = 0
+        self._retry_at = 0.0
+        CUSTOMERS.record_appends(appends, response)
+        CUSTOMERS.updates += len(updates)
+        self.rows_written += len(updates) + len(appends)
+        self.flush_count += 1
+        for _, row in updates:
+            STATS.add_row(row)
+        for row in appends:
+            STATS.add_row(row)
+        try:
+            await asyncio.to_thread(self.outbox.mark_sent, ids)
+        except Exception as e:
+            # Повторная отправка безопасна: строка клиента перезапишется по его ID
+            logger.error(f"Ошибка записи в outbox: {e}")
+        self._inflight = set()
+        logger.info(f"В Google Sheets записано строк: {len(batch)} за {self.last_flush_latency:.2f} сек", extra=SAMPLED)
+        return True
+
+    def stats(self) -> dict:
+        try:
+            backlog = self.outbox.backlog()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать размер outbox: {e}")
+            backlog = None
+        return {
+            "queue_depth": self.depth,
+            "outbox_backlog": backlog,
+            "rows_written": self.rows_written,
+            "rows_replayed": self.rows_replayed,
+            "duplicates_ignored": self.duplicates,
+            "flushes": self.flush_count,
+            "flush_errors": self.flush_errors,
+            "consecutive_errors": self.consecutive_errors,
+            "retry_in_seconds": round(max(0.0, self._retry_at - time.monotonic()), 1),
+            "last_flush_latency_ms": round(self.last_flush_latency * 1000, 1),
+            "max_flush_latency_ms": round(self.max_flush_latency * 1000, 1)
+        }
+
+SHEETS_WRITER = SheetsWriter(SHEETS_BATCH_SIZE, SHEETS_FLUSH_INTERVAL, Outbox(OUTBOX_DB), owner=not SHARD_ID)
+
+# === ИНДЕКС СТАТИСТИКИ ===
+STATS_RECONCILE_INTERVAL = int(os.environ.get("STATS_RECONCILE_INTERVAL", 0))  # секунд, 0 - выключено
+
+# Номера колонок в таблице (см. expected_headers в init_google_sheets)
+COL_DATE = 6
+COL_TARIFF = 7
+
+class StatsIndex:
+    """Агрегаты по клиентам, которые обновляются при каждой записи в таблицу.
+
+    Таблица читается целиком один раз при запуске (и при необязательной
+    сверке по расписанию), а /stats отвечает из памяти. Каждый клиент
+    учитывается один раз: новая строка того же ID меняет тариф, но день
+    регистрации в индексе остается первым. В таблице у повторного клиента
+    дата последней оплаты, поэтому перечитывание сохраняет уже известные
+    индексу (и снимку состояния) даты первой регистрации.
+    """
+
+    def __init__(self):
+        self.reset()
+        self.loaded = False
+        self.last_reconcile = None
+
+    def reset(self):
+        self.total = 0
+        self.revenue = 0
+        self.by_tariff = collections.Counter()
+        self.by_day = collections.Counter()
+        self.customers = {}  # user_id -> (дата регистрации, тариф), вклад клиента в агрегаты
+
+    def add_row(self, row: list):
+        """Учесть одну строку таблицы (или обновить строку уже учтенного клиента)"""
+        user_id = row[0] if row else ''
+        tariff = row[COL_TARIFF] if len(row) > COL_TARIFF else ''
+        date = row[COL_DATE] if len(row) > COL_DATE else ''
+
+        previous = self.customers.get(user_id) if user_id else None
+        if previous:
+            date, old_tariff = previous
+            self.by_tariff[old_tariff] -= 1
+            self.revenue -= TARIFF_PRICES.get(old_tariff, 0)
+        else:
+            self.total += 1
+            self.by_day[date[:10]] += 1
+        if user_id:
+            self.customers[user_id] = (date, tariff)
+        self.by_tariff[tariff] += 1
+        self.revenue += TARIFF_PRICES.get(tariff, 0)
+
+    def load(self, rows: list):
+        """Пересобрать индекс по строкам таблицы (без заголовка)"""
+        first_dates = {user_id: date for user_id, (date, _) in self.customers.items() if date}
+        self.reset()
+        for row in rows:
+            first = first_dates.get(row[0]) if row else None
+            if first and len(row) > COL_DATE and first < row[COL_DATE]:
+                row = row[:COL_DATE] + [first] + row[COL_DATE + 1:]
+            self.add_row(row)
+        self.loaded = True
+
+    def signups_on(self, day: str) -> int:
+        return self.by_day.get(day, 0)
+
+    def snapshot(self) -> dict:
+        return {
+            "total": self.total,
+            "revenue": self.revenue,
+            "by_tariff": dict(self.by_tariff),
+            "today": self.signups_on(datetime.date.today().isoformat()),
+            "loaded": self.loaded
+        }
+
+STATS = StatsIndex()
+
+def read_sheet_rows() -> list:
+    """Все строки клиентов из таблицы без заголовка (блокирующий вызов)"""
+    return SHEET.get_all_values()[1:]
+
+async def load_stats_index():
+    """Первичная загрузка индекса статистики"""
+    if not SHEET:
+        STATS.loaded = True
+        return
+    try:
+        rows = await run_sheets_call("get_all_values", read_sheet_rows)
+        STATS.load(rows)
+        logger.info(f"📊 Индекс статистики загружен: {STATS.total} записей")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки индекса статистики: {e}")
+
+async def reconcile_stats_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая сверка индекса статистики с таблицей"""
+    if not SHEET:
+        return
+    written_before = SHEETS_WRITER.rows_written
+    try:
+        rows = await run_sheets_call("get_all_values", read_sheet_rows)
+    except Exception as e:
+        logger.error(f"Ошибка сверки статистики: {e}")
+        return
+
+    # Если во время чтения успела уйти пачка, результат неоднозначен - ждем следующей сверки
+    if SHEETS_WRITER.rows_written != written_before:
+        return
+
+    previous = STATS.total
+    STATS.load(rows)
+    STATS.last_reconcile = datetime.datetime.now()
+    if STATS.total != previous:
+        logger.warning(f"⚠️ Индекс статистики расходился с таблицей: {previous} против {STATS.total}")
+
+# === ИНДЕКС КЛИЕНТОВ (ID -> СТРОКА ТАБЛИЦЫ) ===
+COL_ID = 1  # колонка ID в таблице (нумерация gspread с 1)
+
+class CustomerIndex:
+    """Номер строки таблицы для каждого ID клиента.
+
+    Строится одним чтением колонки ID при запуске и обновляется после каждой
+    записи. Повторная оплата или исправленный email перезаписывают строку
+    клиента вместо новой, а /start узнает вернувшегося клиента без чтения таблицы.
+    """
+
+    def __init__(self):
+        self.rows = {}  # user_id -> номер строки; None - строка еще в очереди записи
+        self.next_row = 2
+        self.loaded = False
+        self.updates = 0
+        self.appends = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self.rows
+
+    def load(self, ids: list):
+        """Пересобрать индекс по колонке ID (с заголовком); при дублях берется последняя строка"""
+        pending = [user_id for user_id, number in self.rows.items() if number is None]
+        self.rows = {user_id: number for number, user_id in enumerate(ids[1:], start=2) if user_id}
+        for user_id in pending:
+            self.rows.setdefault(user_id, None)
+        self.next_row = max(2, len(ids) + 1)
+        self.loaded = True
+
+    def mark_pending(self, user_id):
+        """Клиент оплатил, но строка еще не записана"""
+        self.rows.setdefault(str(user_id), None)
+
+    def plan(self, batch: list) -> tuple:
+        """Разделить пачку на перезапись известных строк и новые строки.
+
+        Из нескольких строк одного клиента в пачке остается последняя.
+        """
+        latest = {}
+        for row in batch:
+            latest[row[0]] = row
+        updates, appends = [], []
+        for user_id, row in latest.items():
+            number = self.rows.get(user_id)
+            if number:
+                updates.append((number, row))
+            else:
+                appends.append(row)
+        return updates, appends
+
+    def record_appends(self, rows: list, response=None):
+        """Запомнить номера добавленных строк (из updatedRange ответа API, если он есть)"""
+        if not rows:
+            return
+        start = self.next_row
+        updated_range = ""
+        if isinstance(response, dict):
+            updated_range = response.get("updates", {}).get("updatedRange", "")
+        match = re.match(r"[A-Z]+(\d+)", updated_range.rpartition("!")[2])
+        if match:
+            start = int(match.group(1))
+        for offset, row in enumerate(rows):
+            self.rows[row[0]] = start + offset
+        self.next_row = max(self.next_row, start + len(rows))
+        self.appends += len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "customers": len(self.rows),
+            "pending": sum(1 for number in list(self.rows.values()) if number is None),
+            "next_row": self.next_row,
+            "updates": self.updates,
+            "appends": self.appends,
+            "loaded": self.loaded
+        }
+
+CUSTOMERS = CustomerIndex()
+
+def read_customer_ids() -> list:
+    """Колонка ID целиком, с заголовком (блокирующий вызов)"""
+    return SHEET.col_values(COL_ID)
+
+async def load_customer_index() -> bool:
+    """Загрузка индекса клиентов одним чтением колонки ID"""
     if not SHEET:
-        logger.warning("Google Sheets не подключен, данные не сохранены")
         return False
+    try:
+        ids = await run_sheets_call("col_values", read_customer_ids)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки индекса клиентов: {e}")
+        return False
+    CUSTOMERS.load(ids)
+    logger.info(f"🗂 Индекс клиентов загружен: {len(CUSTOMERS)} ID, следующая строка {CUSTOMERS.next_row}")
+    return True
+
+# === ФУНКЦИИ ДЛЯ РАБОТЫ С ДАННЫМИ ===
+async def save_to_google_sheets(user_data: dict, key: str = None):
+    """Сохранение заявки в локальный outbox и постановка в очередь записи в Google Sheets.
+
+    key - ключ идемпотентности (например, user_id и update_id): повтор с тем же
+    ключом не создает вторую заявку.
+    """
+    row_data = [
+        str(user_data.get('user_id', '')),
+        user_data.get('username', ''),
+        user_data.get('name', ''),
+        user_data.get('height', ''),
+        user_data.get('weight', ''),
+        user_data.get('calories', ''),
+        datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        user_data.get('tariff', ''),
+        user_data.get('email', '')
+    ]
     
     try:
-        row_data = [
-            str(user_data.get('user_id', '')),
-            user_data.get('username', ''),
-            user_data.get('name', ''),
-            user_data.get('height', ''),
-            user_data.get('weight', ''),
-            user_data.get('calories', ''),
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            user_data.get('tariff', ''),
-            user_data.get('email', '')
-        ]
-        
-        SHEET.append_row(row_data)
-        logger.info(f"Данные сохранены для пользователя {user_data.get('user_id')}")
-        return True
-        
+        with TRACER.span("outbox"):
+            added = await SHEETS_WRITER.enqueue(row_data, key or uuid.uuid4().hex)
     except Exception as e:
-        logger.error(f"Ошибка при сохранении в Google Sheets: {e}")
+        logger.error(f"❌ Не удалось сохранить заявку пользователя {user_data.get('user_id')} в outbox: {e}")
         return False
+    if not added:
+        logger.info(f"Заявка {key} уже сохранена, повтор пропущен")
+        return True
+    
+    CUSTOMERS.mark_pending(row_data[0])
+    if SHEETS_STATE in ("disabled", "retrying"):
+        logger.warning(f"Google Sheets не подключен, заявка сохранена в outbox (в очереди: {SHEETS_WRITER.depth})")
+    else:
+        logger.info(f"Данные пользователя {user_data.get('user_id')} поставлены в очередь (в очереди: {SHEETS_WRITER.depth})", extra=SAMPLED)
+    return True
+
+# === КАТАЛОГ КОНТЕНТА (ТЕКСТЫ, ФОТО, КЛАВИАТУРЫ) ===
+CONTENT_FILE = os.environ.get(
+    "CONTENT_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "content.json")
+)
+# Как часто проверять изменение файла каталога, сек (0 - только по команде /reload)
+CONTENT_WATCH_INTERVAL = float(os.environ.get("CONTENT_WATCH_INTERVAL", 0))
+
+# Размер страницы отзывов (альбом Telegram вмещает от 2 до 10 фото)
+REVIEWS_PAGE_SIZE = min(10, max(2, int(os.environ.get("REVIEWS_PAGE_SIZE", 5))))
+
+CONTENT_TEXTS = (
+    "start_caption", "menu", "help", "project_description", "project_features",
+    "welcome_back", "choose_section", "tariffs_caption", "reviews_intro", "reviews_more",
+    "tariff_selected", "cancelled", "final_instructions", "group_invite",
+    "payment_success", "invalid_email", "unknown_message", "error_callback", "error_message"
+)
+CONTENT_KEYBOARDS = ("start", "main_menu", "tariffs", "reviews", "continue", "cancel")
+
+def build_keyboard(rows) -> InlineKeyboardMarkup:
+    """[[["Текст", "callback_data"], ...], ...] -> InlineKeyboardMarkup"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+class Content:
+    """Снимок каталога контента, собранный один раз при загрузке.
+
+    Тексты, адреса фото и готовые InlineKeyboardMarkup (в PTB они неизменяемые)
+    общие для всех обработчиков. При перезагрузке каталога снимок не меняется,
+    а заменяется целиком новым, поэтому обработчик, взявший CONTENT в начале,
+    видит согласованную версию до конца.
+    """
+
+    def __init__(self, data: dict, mtime: float = 0.0):
+        texts = data.get("texts", {})
+        missing = [key for key in CONTENT_TEXTS if not texts.get(key)]
+        if missing:
+            raise ValueError(f"в каталоге нет текстов: {', '.join(missing)}")
+        keyboards = data.get("keyboards", {})
+        missing = [key for key in CONTENT_KEYBOARDS if key not in keyboards]
+        if missing:
+            raise ValueError(f"в каталоге нет клавиатур: {', '.join(missing)}")
+        media = data.get("media", {})
+        for key in ("start", "tariffs"):
+            if not media.get(key):
+                raise ValueError(f"в каталоге нет фото {key}")
+
+        self.texts = types.MappingProxyType({key: str(value) for key, value in texts.items()})
+        self.media = types.MappingProxyType({key: str(value).strip() for key, value in media.items()})
+        self.keyboards = types.MappingProxyType({
+            key: build_keyboard(rows) for key, rows in keyboards.items()
+        })
+
+        # Страницы отзывов и клавиатуры к ним считаются заранее
+        self.review_photos = tuple(key for key in self.media if key.startswith("review_"))
+        self.review_pages = tuple(
+            self.review_photos[start:start + REVIEWS_PAGE_SIZE]
+            for start in range(0, len(self.review_photos), REVIEWS_PAGE_SIZE)
+        ) or ((),)
+        more_text = data.get("buttons", {}).get("more_reviews", "Ещё отзывы 👀")
+        reviews_rows = keyboards["reviews"]
+        self.reviews_keyboards = tuple(
+            build_keyboard(
+                ([[[more_text, f"reviews_page_{page + 1}"]]] if page + 1 < len(self.review_pages) else [])
+                + reviews_rows
+            )
+            for page in range(len(self.review_pages))
+        )
+
+        self.mtime = mtime
+        self.version = hashlib.sha256(
+            json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:12]
+        self.loaded_at = time.time()
+
+    @classmethod
+    def from_file(cls, path: str) -> "Content":
+        mtime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f), mtime)
+
+    def text(self, key: str, **kwargs) -> str:
+        """Текст по ключу; для шаблонов подставляются параметры"""
+        value = self.texts[key]
+        return value.format(**kwargs) if kwargs else value
+
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "loaded_at": datetime.datetime.fromtimestamp(self.loaded_at).isoformat(),
+            "texts": len(self.texts),
+            "photos": len(self.media),
+            "keyboards": len(self.keyboards),
+            "review_pages": len(self.review_pages)
+        }
+
+CONTENT = Content.from_file(CONTENT_FILE)
+logger.info(f"📚 Каталог контента загружен: версия {CONTENT.version}, текстов {len(CONTENT.texts)}")
+
+def reload_content(force: bool = False):
+    """Перечитать каталог; при ошибке остается прежняя версия.
+
+    Возвращает (перезагружен ли каталог, описание результата).
+    """
+    global CONTENT
+    try:
+        if not force and os.stat(CONTENT_FILE).st_mtime == CONTENT.mtime:
+            return False, "без изменений"
+        content = Content.from_file(CONTENT_FILE)
+    except Exception as e:
+        logger.error(f"❌ Каталог контента не перезагружен, остается версия {CONTENT.version}: {e}")
+        return False, f"ошибка: {e}"
+
+    if content.version == CONTENT.version:
+        CONTENT = content
+        return False, "без изменений"
+
+    previous = CONTENT.version
+    MEDIA.update_assets(content.media)
+    CONTENT = content
+    logger.info(f"🔄 Каталог контента перезагружен: {previous} -> {content.version}")
+    return True, f"версия {previous} -> {content.version}"
+
+async def content_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая проверка файла каталога на изменения"""
+    reload_content()
+
+# === КЭШ МЕДИА (file_id TELEGRAM) ===
+MEDIA_CACHE_FILE = shard_path(os.environ.get("MEDIA_CACHE_FILE", "media_cache.json"))
+
+class MediaRegistry:
+    """Реестр file_id изображений, уже загруженных в Telegram.
+
+    Каждое изображение скачивается Telegram по URL только один раз,
+    дальше отправляется ссылкой на file_id. Реестр хранится на диске
+    и переживает перезапуски.
+    """
+
+    def __init__(self, path: str, assets: dict):
+        self.path = path
+        self.assets = assets
+        self.file_ids = {}
+        self.unique_ids = {}  # file_unique_id: одно изображение под разными file_id
+        self.hits = 0
+        self.uploads = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось прочитать кэш медиа {self.path}: {e}")
+            return
+
+        for key, entry in stored.items():
+            if self.assets.get(key) == entry.get("source") and entry.get("file_id"):
+                self.file_ids[key] = entry["file_id"]
+                if entry.get("file_unique_id"):
+                    self.unique_ids[key] = entry["file_unique_id"]
+        logger.info(f"📦 Загружено file_id из кэша медиа: {len(self.file_ids)}")
+
+    def _save(self):
+        data = {
+            key: {"source": self.assets[key], "file_id": file_id, "file_unique_id": self.unique_ids.get(key)}
+            for key, file_id in self.file_ids.items()
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить кэш медиа: {e}")
+
+    def get(self, key: str) -> str:
+        """file_id, если изображение уже загружено, иначе исходный URL"""
+        file_id = self.file_ids.get(key)
+        if file_id:
+            self.hits += 1
+            return file_id
+        self.uploads += 1
+        return self.assets[key]
+
+    def remember(self, key: str, message):
+        """Запомнить file_id из отправленного сообщения"""
+        if not message or not message.photo:
+            return
+        photo = message.photo[-1]
+        if self.file_ids.get(key) != photo.file_id or self.unique_ids.get(key) != photo.file_unique_id:
+            self.file_ids[key] = photo.file_id
+            self.unique_ids[key] = photo.file_unique_id
+            self._save()
+
+    def shows(self, key: str, message) -> bool:
+        """В сообщении уже фото этого изображения.
+
+        file_id одного и того же изображения отличается от сообщения к
+        сообщению, сравнивается постоянный file_unique_id.
+        """
+        return bool(message.photo) and self.unique_ids.get(key) == message.photo[-1].file_unique_id
+
+    def forget(self, key: str):
+        self.unique_ids.pop(key, None)
+        if self.file_ids.pop(key, None):
+            self._save()
+
+    def update_assets(self, assets):
+        """Новые адреса из каталога: file_id изображений с другим адресом сбрасываются"""
+        stale = [key for key in self.file_ids if assets.get(key) != self.assets.get(key)]
+        self.assets = assets
+        for key in stale:
+            del self.file_ids[key]
+            self.unique_ids.pop(key, None)
+        if stale:
+            logger.info(f"🖼 Сброшены file_id измененных изображений: {', '.join(stale)}")
+            self._save()
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self.file_ids),
+            "assets": len(self.assets),
+            "hits": self.hits,
+            "uploads": self.uploads
+        }
+
+MEDIA = MediaRegistry(MEDIA_CACHE_FILE, CONTENT.media)
+
+async def send_cached_photo(bot, chat_id: int, key: str, **kwargs):
+    """Отправка фото через кэш file_id с повторной загрузкой по URL, если file_id устарел"""
+    photo = MEDIA.get(key)
+    try:
+        with TRACER.span(f"photo:{key}" if photo != MEDIA.assets[key] else f"photo_url:{key}"):
+            message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    except BadRequest as e:
+        if photo == MEDIA.assets[key]:
+            raise
+        logger.warning(f"⚠️ file_id для {key} недействителен, загружаем заново: {e}")
+        MEDIA.forget(key)
+        with TRACER.span(f"photo_url:{key}"):
+            message = await bot.send_photo(chat_id=chat_id, photo=MEDIA.get(key), **kwargs)
+    MEDIA.remember(key, message)
+    return message
+
+# === ОТЗЫВЫ ===
+async def send_review_album(bot, chat_id: int, keys: list):
+    """Отправка страницы отзывов одним альбомом"""
+    if not keys:
+        return
+    if len(keys) == 1:
+        await send_cached_photo(bot, chat_id, keys[0])
+        return
+
+    media = [MEDIA.get(key) for key in keys]
+    try:
+        messages = await bot.send_media_group(
+            chat_id=chat_id,
+            media=[InputMediaPhoto(item) for item in media]
+        )
+    except BadRequest as e:
+        if media == [MEDIA.assets[key] for key in keys]:
+            raise
+        logger.warning(f"⚠️ file_id в альбоме отзывов недействительны, загружаем заново: {e}")
+        for key in keys:
+            MEDIA.forget(key)
+        messages = await bot.send_media_group(
+            chat_id=chat_id,
+            media=[InputMediaPhoto(MEDIA.get(key)) for key in keys]
+        )
+
+    for key, message in zip(keys, messages):
+        MEDIA.remember(key, message)
+
+async def send_reviews_page(bot, chat_id: int, page: int = 0):
+    """Отправка страницы отзывов: альбом и одно сообщение с кнопками"""
+    content = CONTENT
+    page = min(max(page, 0), len(content.review_pages) - 1)
+
+    try:
+        await send_review_album(bot, chat_id, content.review_pages[page])
+    except Exception as e:
+        logger.error(f"Ошибка отправки отзывов (страница {page + 1}): {e}")
+
+    await bot.send_message(
+        chat_id=chat_id,
+        text=content.text("reviews_intro" if page == 0 else "reviews_more"),
+        reply_markup=content.reviews_keyboards[page]
+    )
 
 # === КОМАНДЫ МЕНЮ БОТА ===
 async def set_bot_commands(application: Application):
@@ -223,77 +2811,185 @@ async def set_bot_commands(application: Application):
         BotCommand("reviews", "Отзывы")
     ]
     
-    await application.bot.set_my_commands(commands)
-    logger.info("✅ Команды меню установлены")
+    try:
+        with STARTUP.phase("set_commands"):
+            await application.bot.set_my_commands(commands)
+        logger.info("✅ Команды меню установлены")
+    except Exception as e:
+        logger.error(f"Не удалось установить команды меню: {e}")
 
 # === INLINE КЛАВИАТУРЫ ===
+# Клавиатуры собираются один раз при загрузке каталога и общие для всех сообщений
 def get_start_keyboard():
     """Клавиатура для команды /start"""
-    keyboard = [
-        [InlineKeyboardButton("Хочу в проект 💪", callback_data='want_project')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return CONTENT.keyboards["start"]
 
 def get_main_menu_keyboard():
     """Основное меню после описания проекта"""
-    keyboard = [
-        [InlineKeyboardButton("Тарифы 💰", callback_data='tariffs')],
-        [InlineKeyboardButton("Отзывы 🥹", callback_data='reviews')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return CONTENT.keyboards["main_menu"]
 
 def get_tariffs_keyboard():
     """Клавиатура с тарифами"""
-    keyboard = [
-        [InlineKeyboardButton("15 дней (1990 ₽)", callback_data='tariff_15')],
-        [InlineKeyboardButton("1 месяц (3000 ₽)", callback_data='tariff_30')],
-        [InlineKeyboardButton("3 месяца (6990 ₽)", callback_data='tariff_90')],
-        [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_main')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return CONTENT.keyboards["tariffs"]
 
-def get_reviews_keyboard():
-    """Клавиатура после отзывов"""
-    keyboard = [
-        [InlineKeyboardButton("Тарифы 💰", callback_data='tariffs')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def get_reviews_keyboard(page=0):
+    """Клавиатура после страницы отзывов (с кнопкой «Ещё отзывы», если есть следующая)"""
+    keyboards = CONTENT.reviews_keyboards
+    return keyboards[min(max(page, 0), len(keyboards) - 1)]
 
 def get_continue_keyboard():
     """Клавиатура после оплаты"""
-    keyboard = [
-        [InlineKeyboardButton("Продолжить ▶️", callback_data='continue')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return CONTENT.keyboards["continue"]
 
 def get_cancel_keyboard():
     """Клавиатура для отмены ввода email"""
-    keyboard = [
-        [InlineKeyboardButton("Отмена", callback_data='cancel')]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return CONTENT.keyboards["cancel"]
+
+# === БУФЕР ИСХОДЯЩИХ СООБЩЕНИЙ ===
+MESSAGE_LIMIT = 4096  # лимит Telegram на длину текста (в единицах UTF-16)
+MESSAGE_SEPARATOR = "\n\n"
+
+SEND_BUFFER_STATS = collections.Counter()  # texts - добавлено в буферы, messages - отправлено
+
+def telegram_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+class SendBuffer:
+    """Тексты одного ответа пользователю, отправляемые как можно меньшим числом сообщений.
+
+    Подряд идущие тексты склеиваются через пустую строку, пока сообщение
+    укладывается в MESSAGE_LIMIT. Текст с клавиатурой закрывает сообщение
+    (клавиатура остается у последнего текста перед ней), тексты с разным
+    parse_mode не склеиваются. Порядок сохраняется. Отправка - при выходе
+    из async with без исключения или вызовом flush().
+    """
+
+    def __init__(self, bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.parts = []  # (текст, parse_mode, клавиатура)
+
+    def add(self, text: str, reply_markup=None, parse_mode: str = None):
+        self.parts.append((text, parse_mode, reply_markup))
+
+    def plan(self) -> list:
+        """Сообщения к отправке: [(текст, parse_mode, клавиатура)]"""
+        messages = []
+        for text, parse_mode, reply_markup in self.parts:
+            if messages:
+                last_text, last_mode, last_markup = messages[-1]
+                merged = f"{last_text}{MESSAGE_SEPARATOR}{text}"
+                if last_markup is None and last_mode == parse_mode and telegram_length(merged) <= MESSAGE_LIMIT:
+                    messages[-1] = (merged, parse_mode, reply_markup)
+                    continue
+            messages.append((text, parse_mode, reply_markup))
+        return messages
+
+    async def flush(self) -> list:
+        messages = self.plan()
+        SEND_BUFFER_STATS["texts"] += len(self.parts)
+        self.parts = []
+        sent = []
+        for text, parse_mode, reply_markup in messages:
+            sent.append(await self.bot.send_message(
+                chat_id=self.chat_id,
+                text=text,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup
+            ))
+            SEND_BUFFER_STATS["messages"] += 1
+        return sent
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.flush()
+
+# === НАВИГАЦИЯ ПО МЕНЮ (РЕДАКТИРОВАНИЕ СООБЩЕНИЙ) ===
+NAVIGATION_MODE = os.environ.get("NAVIGATION_MODE", "edit")  # edit | send (каждый экран новым сообщением)
+CAPTION_LIMIT = 1024  # лимит Telegram на подпись к фото
+MENU_PHOTO = "start"  # фото экрана главного меню
+
+# Меню, тарифы, выбор тарифа и отмена - экраны с фото: переходы между
+# ними меняют подпись или фото того же сообщения. Кнопка «Тарифы» под
+# текстом отзывов по-прежнему отправляет новый экран.
+
+NAVIGATION_STATS = collections.Counter()  # edited | unchanged | fallback
+
+async def edit_screen(query, text: str, reply_markup, photo_key: str = None, parse_mode: str = None) -> bool:
+    """Показать экран в сообщении с нажатой кнопкой вместо отправки нового.
+
+    photo_key - экран с фото из каталога: фото сообщения меняется через
+    edit_message_media, если там другое изображение, иначе меняется только
+    подпись. False - редактировать
+    нельзя (режим send, текст не превратить в фото и наоборот, длинная
+    подпись, старое сообщение), экран нужно отправить новым сообщением.
+    """
+    message = query.message
+    if NAVIGATION_MODE != "edit" or message is None:
+        return False
+    # Текстовый экран не показываем поверх фото другого экрана
+    if bool(photo_key) != bool(message.photo) or (photo_key and telegram_length(text) > CAPTION_LIMIT) or not (message.photo or message.text):
+        NAVIGATION_STATS["fallback"] += 1
+        return False
+
+    try:
+        if photo_key and not MEDIA.shows(photo_key, message):
+            edited = await query.edit_message_media(
+                InputMediaPhoto(MEDIA.get(photo_key), caption=text, parse_mode=parse_mode),
+                reply_markup=reply_markup
+            )
+            MEDIA.remember(photo_key, edited)
+        elif photo_key:
+            await query.edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode)
+        else:
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest as e:
+        # Повторное нажатие той же кнопки: экран уже показан
+        if "not modified" in str(e).lower():
+            NAVIGATION_STATS["unchanged"] += 1
+            return True
+        logger.warning(f"⚠️ Не удалось отредактировать сообщение {message.message_id}, отправляем новое: {e}")
+        NAVIGATION_STATS["fallback"] += 1
+        return False
+    NAVIGATION_STATS["edited"] += 1
+    return True
+
+async def send_photo_screen(bot, chat_id: int, photo_key: str, caption: str, reply_markup):
+    """Экран с фото новым сообщением (текстом, если фото не отправилось)"""
+    try:
+        await send_cached_photo(bot, chat_id, photo_key, caption=caption, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Ошибка отправки фото {photo_key}: {e}")
+        await bot.send_message(chat_id=chat_id, text=caption, reply_markup=reply_markup)
+
+async def show_photo_screen(query, bot, photo_key: str, caption: str, reply_markup):
+    """Экран с фото в сообщении с нажатой кнопкой или новым сообщением"""
+    if await edit_screen(query, caption, reply_markup, photo_key=photo_key):
+        return
+    await send_photo_screen(bot, query.message.chat_id, photo_key, caption, reply_markup)
 
 # === ОСНОВНЫЕ ОБРАБОТЧИКИ ===
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} ({user.username}) начал диалог")
+    logger.info(f"Пользователь {user.id} ({user.username}) начал диалог", extra=SAMPLED)
     
     if 'user_data' in context.user_data:
         context.user_data.clear()
     
-    photo_url = "https://i.ibb.co/pr4CxkkM/1.jpg  "
-    caption = (
-        "«POLINAFIT» — место, где ты обретёшь новую версию себя! 💫\n\n"
-        "Проект — это не краткосрочный марафон. Это про индивидуальный подход к каждой участнице!\n\n"
-        "Я даю рекомендации по питанию, после того как подробно изучу каждый индивидуальный случай, "
-        "исходя из вашей ситуации, образа жизни, активности, вида деятельности, возможные травмы. "
-        "Именно такой подход поможет тебе достичь поставленной цели!"
-    )
+    caption = CONTENT.text("start_caption")
+    if user.id in CUSTOMERS:
+        caption = f"{CONTENT.text('welcome_back')}\n\n{caption}"
     
     try:
-        await update.message.reply_photo(
-            photo=photo_url, 
+        await send_cached_photo(
+            context.bot,
+            update.message.chat_id,
+            "start",
             caption=caption,
             reply_markup=get_start_keyboard()
         )
@@ -304,340 +3000,117 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=get_start_keyboard()
         )
 
+@timed_handler
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /menu - показать главное меню"""
-    menu_text = (
-        "📋 **Главное меню POLINAFIT**\n\n"
-        "Доступные команды (используйте меню слева от поля ввода):\n\n"
-        "🚀 /start - Начать работу с ботом\n"
-        "📋 /menu - Показать это меню\n"
-        "💪 /project - Описание проекта\n"
-        "💰 /tariffs - Показать тарифы\n"
-        "🥹 /reviews - Показать отзывы\n"
-        "❓ /help - Помощь и инструкции\n\n"
-        "Или используйте кнопки под сообщениями ⬇️"
-    )
+    menu_text = CONTENT.text("menu")
     
     await update.message.reply_text(
         menu_text,
         parse_mode="Markdown"
     )
 
+async def send_project_texts(bot, chat_id: int):
+    """Описание проекта, что в него входит, и меню выбора"""
+    content = CONTENT
+    async with SendBuffer(bot, chat_id) as out:
+        out.add(content.text("project_description"))
+        out.add(content.text("project_features"))
+    # Меню - экран с фото, дальше навигация редактирует это сообщение
+    await send_photo_screen(bot, chat_id, MENU_PHOTO, content.text("choose_section"), content.keyboards["main_menu"])
+
+@timed_handler
 async def project_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /project - описание проекта"""
-    desc = (
-        "Проект POLINAFIT- это комплексная работа,где важно абсолютно всё! Режим питания,тренировки,"
-        "поддержка от участниц проекта и лично меня! Это то, место где я помогу тебе дойти до результата, "
-        "доведу тебя за ручку до твоей цели, место где ты не откатишься назад и не потеряешь результат, "
-        "если случились непредвиденные обстоятельства (отпуск,стресс,травмы,болезнь итд)"
-    )
-    
-    await update.message.reply_text(desc)
-    
-    features = (
-        "Что входит в проект:\n\n"
-        "🤍 Тренировки для любого уровня подготовки дома или в зале:\n"
-        "— легкие , для тех кто только начинает\n"
-        "— средней сложности, для тех кто уже занимается\n"
-        "— интенсивные, для тех кто тренируется регулярно и хочет прогрессировать и готов к нагрузкам\n\n"
-        "🤍 Питание:\n"
-        "индивидуальный расчет КБЖУ, исходя из ваших особенностей, активности и образа жизни, "
-        "анализ динамики и изменения расчета по необходимости большие сборники завтраков,обедов и ужинов "
-        "с указанием КБЖУ каждого блюда , для того чтобы тебе было легче подбирать рацион\n\n"
-        "🤍 Индивидуальная работа с отчетами:\n"
-        "2 раза в неделю проверяю лично отчеты по питанию, по необходимости вношу корректировки "
-        "для более эффективного результата поставленной цели\n"
-        "2 раза в месяц проверяю отчеты по форме,фиксируем замеры , на основе которых могу изменить "
-        "тренировочный план или норму КБЖУ\n\n"
-        "🤍 Абсолютно любая цель:\n"
-        "— снижение веса\n"
-        "— набор веса\n\n"
-        "🤍 Доступ к чату со всеми девочками участницами , там мы обсуждаем результаты,делимся эмоциями, "
-        "рецептами, просто болтаем и поддерживаем друг друга на протяжении каждого дня, заряжаемся позитивом, "
-        "настраиваемся на продуктивные дни, там ты всегда можешь задать мне интересующий тебя вопрос. "
-        "Ведь так важно знать,что ты не один и тебя всегда поддержат!🫂"
-    )
-    
-    await update.message.reply_text(features)
-    
-    await update.message.reply_text(
-        "Выбери, что хочешь узнать:",
-        reply_markup=get_main_menu_keyboard()
-    )
+    await send_project_texts(context.bot, update.message.chat_id)
 
+@timed_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
-    help_text = (
-        "🆘 **Помощь и поддержка**\n\n"
-        "Если у вас возникли вопросы или проблемы:\n\n"
-        "📞 **Связь с менеджером:** @your_trainer\n"
-        "💬 **Общий чат:** https://t.me/plans_channel  \n"
-        "📚 **Закрытая группа:** https://t.me/recipes_group  \n\n"
-        "**Команды бота:**\n"
-        "/start - Начать диалог\n"
-        "/menu - Показать меню\n"
-        "/project - Описание проекта\n"
-        "/tariffs - Тарифы\n"
-        "/reviews - Отзывы\n"
-        "/help - Эта справка"
-    )
+    help_text = CONTENT.text("help")
     
     await update.message.reply_text(
         help_text,
         parse_mode="Markdown"
     )
 
+@timed_handler
 async def send_project_description(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправка описания проекта - БЕЗ УДАЛЕНИЯ ПЕРВОГО СООБЩЕНИЯ"""
     query = update.callback_query
     await query.answer()
     
     # НЕ удаляем первое сообщение с фото и кнопкой!
-    # Просто отправляем новое сообщение с описанием
-    
-    desc = (
-        "Проект POLINAFIT- это комплексная работа,где важно абсолютно всё! Режим питания,тренировки,"
-        "поддержка от участниц проекта и лично меня! Это то, место где я помогу тебе дойти до результата, "
-        "доведу тебя за ручку до твоей цели, место где ты не откатишься назад и не потеряешь результат, "
-        "если случились непредвиденные обстоятельства (отпуск,стресс,травмы,болезнь итд)"
-    )
-    
-    # Отправляем описание как новое сообщение
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text=desc
-    )
-    
-    features = (
-        "Что входит в проект:\n\n"
-        "🤍 Тренировки для любого уровня подготовки дома или в зале:\n"
-        "— легкие , для тех кто только начинает\n"
-        "— средней сложности, для тех кто уже занимается\n"
-        "— интенсивные, для тех кто тренируется регулярно и хочет прогрессировать и готов к нагрузкам\n\n"
-        "🤍 Питание:\n"
-        "индивидуальный расчет КБЖУ, исходя из ваших особенностей, активности и образа жизни, "
-        "анализ динамики и изменения расчета по необходимости большие сборники завтраков,обедов и ужинов "
-        "с указанием КБЖУ каждого блюда , для того чтобы тебе было легче подбирать рацион\n\n"
-        "🤍 Индивидуальная работа с отчетами:\n"
-        "2 раза в неделю проверяю лично отчеты по питанию, по необходимости вношу корректировки "
-        "для более эффективного результата поставленной цели\n"
-        "2 раза в месяц проверяю отчеты по форме,фиксируем замеры , на основе которых могу изменить "
-        "тренировочный план или норму КБЖУ\n\n"
-        "🤍 Абсолютно любая цель:\n"
-        "— снижение веса\n"
-        "— набор веса\n\n"
-        "🤍 Доступ к чату со всеми девочками участницами , там мы обсуждаем результаты,делимся эмоциями, "
-        "рецептами, просто болтаем и поддерживаем друг друга на протяжении каждого дня, заряжаемся позитивом, "
-        "настраиваемся на продуктивные дни, там ты всегда можешь задать мне интересующий тебя вопрос. "
-        "Ведь так важно знать,что ты не один и тебя всегда поддержат!🫂"
-    )
-    
-    # Отправляем особенности как новое сообщение
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text=features
-    )
-    
-    # Отправляем кнопки выбора
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Выбери, что хочешь узнать:",
-        reply_markup=get_main_menu_keyboard()
-    )
+    # Просто отправляем новые сообщения с описанием
+    await send_project_texts(context.bot, query.message.chat_id)
 
+@timed_handler
 async def send_tariffs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Отправка информации о тарифах"""
     query = update.callback_query
     await query.answer()
     
-    # Отправляем новое сообщение с фото тарифов
-    photo_url = "https://i.ibb.co/F9mRf4f/Tarif.jpg  "
-    caption = (
-        "В проекте действует подписка, которая открывает тебе доступ к следующим преимуществам:\n\n"
-        "🤍 Анализ состояния для подбора питания и тренировок\n"
-        "🤍 Индивидуальный расчет КБЖУ и план тренировок, составленный лично\n"
-        "🤍 Тренировки на любую цель ( жиросжигание,силовые итп)\n"
-        "🤍 Возможность тренироваться где удобно, дома или в зале\n"
-        "🤍 Подробно расписанная техника каждого упражнения и возможность задавать вопросы по технике в общий чат\n"
-        "🤍 Контроль питания и формы каждую неделю\n"
-        "🤍 Общий чат с участницами проекта\n"
-        "🤍 Возможность задавать любые вопросы по теме питания\n"
-        "🤍 Огромный сборник простых,бюджетных рецептов\n"
-        "🤍 Гайд по продуктам\n"
-        "🤍 Путеводитель по питанию\n"
-        "🤍 Подробное видео с часто задаваемыми вопросами, связанные с питанием и тренировками\n"
-    )
-    
-    try:
-        await context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=photo_url,
-            caption=caption,
-            reply_markup=get_tariffs_keyboard()
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки фото тарифов: {e}")
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=caption,
-            reply_markup=get_tariffs_keyboard()
-        )
+    await show_photo_screen(query, context.bot, "tariffs", CONTENT.text("tariffs_caption"), get_tariffs_keyboard())
 
+@timed_handler
 async def send_reviews(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправка отзывов"""
-    query = update.callback_query
-    await query.answer()
-    
-    review_photos = [
-        "https://i.ibb.co/N6yx0vQ7/Otziv-foto.jpg  ",
-        "https://i.ibb.co/qLgkfHqk/Otziv-foto-2.jpg  ",
-        "https://i.ibb.co/zWxK49Xb/Otziv-foto-1.jpg  ",
-        "https://i.ibb.co/HD66d5vd/Otziv-1.jpg  ",
-        "https://i.ibb.co/mVrGJPWs/Otziv-2.jpg  ",
-        "https://i.ibb.co/G3B9Fpt3/Otziv-3.jpg  ",
-        "https://i.ibb.co/xSDjZs9F/Otziv-4.jpg  ",
-        "https://i.ibb.co/394skJ6t/Otziv-5.jpg  ",
-        "https://i.ibb.co/ccRXCJ6p/Otziv.jpg  "
-    ]
-
-    # Отправляем первые 5 отзывов
-    for i, url in enumerate(review_photos[:5]):
-        try:
-            await context.bot.send_photo(
-                chat_id=query.message.chat_id,
-                photo=url
-            )
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            logger.error(f"Ошибка отправки отзыва {i+1}: {e}")
-            continue
+    """Отправка отзывов"""
+    query = update.callback_query
+    await query.answer()
+    
+    await send_reviews_page(context.bot, query.message.chat_id, 0)
 
-    # Отправляем текст и кнопку после отзывов
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Ты только посмотри на отзывы моих девочек 🥹 А это всего один месяц работы! ВАУ!!!"
-    )
+@timed_handler
+async def handle_reviews_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка кнопки «Ещё отзывы»"""
+    query = update.callback_query
+    await query.answer()
     
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Хочешь тоже так? Жми 👇",
-        reply_markup=get_reviews_keyboard()
-    )
+    page = int(query.data.rsplit('_', 1)[1])
+    await send_reviews_page(context.bot, query.message.chat_id, page)
 
+@timed_handler
 async def tariffs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /tariffs"""
-    photo_url = "https://i.ibb.co/F9mRf4f/Tarif.jpg  "
-    caption = (
-        "В проекте действует подписка, которая открывает тебе доступ к следующим преимуществам:\n\n"
-        "🤍 Анализ состояния для подбора питания и тренировок\n"
-        "🤍 Индивидуальный расчет КБЖУ и план тренировок, составленный лично\n"
-        "🤍 Тренировки на любую цель ( жиросжигание,силовые итп)\n"
-        "🤍 Возможность тренироваться где удобно, дома или в зале\n"
-        "🤍 Подробно расписанная техника каждого упражнения и возможность задавать вопросы по технике в общий чат\n"
-        "🤍 Контроль питания и формы каждую неделю\n"
-        "🤍 Общий чат с участницами проекта\n"
-        "🤍 Возможность задавать любые вопросы по теме питания\n"
-        "🤍 Огромный сборник простых,бюджетных рецептов\n"
-        "🤍 Гайд по продуктам\n"
-        "🤍 Путеводитель по питанию\n"
-        "🤍 Подробное видео с часто задаваемыми вопросами, связанные с питанием и тренировками\n"
-    )
-    
-    try:
-        await update.message.reply_photo(
-            photo=photo_url,
-            caption=caption,
-            reply_markup=get_tariffs_keyboard()
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки фото тарифов: {e}")
-        await update.message.reply_text(
-            caption,
-            reply_markup=get_tariffs_keyboard()
-        )
+    await send_photo_screen(context.bot, update.message.chat_id, "tariffs", CONTENT.text("tariffs_caption"), get_tariffs_keyboard())
 
+@timed_handler
 async def reviews_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /reviews"""
-    review_photos = [
-        "https://i.ibb.co/N6yx0vQ7/Otziv-foto.jpg  ",
-        "https://i.ibb.co/qLgkfHqk/Otziv-foto-2.jpg  ",
-        "https://i.ibb.co/zWxK49Xb/Otziv-foto-1.jpg  ",
-        "https://i.ibb.co/HD66d5vd/Otziv-1.jpg  ",
-        "https://i.ibb.co/mVrGJPWs/Otziv-2.jpg  ",
-        "https://i.ibb.co/G3B9Fpt3/Otziv-3.jpg  ",
-        "https://i.ibb.co/xSDjZs9F/Otziv-4.jpg  ",
-        "https://i.ibb.co/394skJ6t/Otziv-5.jpg  ",
-        "https://i.ibb.co/ccRXCJ6p/Otziv.jpg  "
-    ]
-
-    # Отправляем первые 5 отзывов
-    for i, url in enumerate(review_photos[:5]):
-        try:
-            await update.message.reply_photo(photo=url)
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            logger.error(f"Ошибка отправки отзыва {i+1}: {e}")
-            continue
-
-    await update.message.reply_text(
-        "Ты только посмотри на отзывы моих девочек 🥹 А это всего один месяц работы! ВАУ!!!"
-    )
-    
-    await update.message.reply_text(
-        "Хочешь тоже так? Жми 👇",
-        reply_markup=get_reviews_keyboard()
-    )
+    await send_reviews_page(context.bot, update.message.chat_id, 0)
 
-async def handle_tariff_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, tariff_data: str):
-    """Обработка выбора тарифа"""
+@timed_handler
+async def handle_tariff_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка выбора тарифа (переход в ожидание email)"""
     query = update.callback_query
     await query.answer()
     
-    tariff_map = {
-        'tariff_15': '15 дней (1990 ₽)',
-        'tariff_30': '1 месяц (3000 ₽)',
-        'tariff_90': '3 месяца (6990 ₽)'
-    }
-    
-    tariff = tariff_map.get(tariff_data)
+    tariff = TARIFFS.get(query.data, {}).get('title')
     if tariff:
-        context.user_data['tariff'] = tariff
-        USER_STATES[query.from_user.id] = "waiting_for_email"
+        # В сессии, а не в user_data: следующий шаг может обработать другой процесс
+        USER_STATES.update_data(update.effective_user.id, tariff=tariff)
         
-        # Отправляем новое сообщение с запросом email
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"Вы выбрали: {tariff}\n\n"
-                 "Пожалуйста, укажи свой email — я отправлю тебе чек после оплаты:",
-            reply_markup=get_cancel_keyboard()
-        )
+        # Запрос email - подпись под фото тарифов
+        text = CONTENT.text("tariff_selected", tariff=tariff)
+        await show_photo_screen(query, context.bot, "tariffs", text, get_cancel_keyboard())
 
+@timed_handler
 async def handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кнопки назад"""
     query = update.callback_query
     await query.answer()
     
-    # Отправляем новое сообщение с главным меню
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Выбери, что хочешь узнать:",
-        reply_markup=get_main_menu_keyboard()
-    )
+    await show_photo_screen(query, context.bot, MENU_PHOTO, CONTENT.text("choose_section"), get_main_menu_keyboard())
 
+@timed_handler
 async def handle_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка отмены"""
+    """Обработка отмены (возврат в начало воронки)"""
     query = update.callback_query
     await query.answer()
     
-    USER_STATES.pop(query.from_user.id, None)
-    
-    # Отправляем новое сообщение с главным меню
-    await context.bot.send_message(
-        chat_id=query.message.chat_id,
-        text="Действие отменено. Что хочешь сделать?",
-        reply_markup=get_main_menu_keyboard()
-    )
+    await show_photo_screen(query, context.bot, MENU_PHOTO, CONTENT.text("cancelled"), get_main_menu_keyboard())
 
+@timed_handler
 async def handle_continue(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка кнопки продолжить"""
     query = update.callback_query
@@ -653,172 +3126,121 @@ async def send_final_instructions(update: Update, context: ContextTypes.DEFAULT_
     else:
         chat_id = update.message.chat_id
     
-    instruction = (
-        "Дорогая, я рада тебя приветствовать в проекте POLINAFIT🥳\n"
-        "Поздравляю,ты на шаг к своему идеальному телу! 🪄\n\n"
-        "Для того, чтобы нам структурировано продолжить работать, давай я расскажу что ты должна сделать:\n\n"
-        "🤍Для начала ты должна мне отправить анкету со всеми твоими данными, она находится в закрытом телеграмм канале, где собрана вся информация по питанию, важным вопросам, меню, анкеты для отчетов по питанию и форме\n"
-        "В этом канале есть вверху закрепленное сообщение под названием «НАВИГАЦИЯ», как только  ты зайдешь в канал, жми на «НАВИГАЦИЮ»\n"
-        "затем на кликабельную кнопку «АНКЕТА ДЛЯ ВСТУПЛЕНИЕ В ПРОЕКТ»\n"
-        "тебя перебросит сразу на анкету, скопируй анкету и вставь её в сообщения в ЛИЧНОМ ЧАТЕ СО МНОЙ\n"
-        "заполни анкету подробно, отправляй её мне и ВОЗВРАЩАЙСЯ В ЗАКРЫТЫЙ КАНАЛ для изучения всей информации.\n\n"
-        "БОЛЬШАЯ ПРОСЬБА, ИЗУЧАТЬ МАТЕРИАЛ ПОСЛЕДОВАТЕЛЬНО, просматривать и читать сообщения с верху вниз, так ты не запутаешься и в твоей голове все разложится по полочкам\n"
-        "Так же, в навигации ты найдешь кликабельные кнопки на анкеты для отчета по питанию и отчета по форме, которые тебе часто будут нужны\n\n"
-        "ЕСЛИ ТЫ ВСЕ ПРОЧИТАЛА И ПОНЯЛА КАК НАМ РАБОТАТЬ ДАЛЬШЕ, ЖМИ «ПРОДОЛЖИТЬ»"
-    )
-    
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text=instruction
-    )
-    
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="Вступай в закрытую группу со всей информацией 🫶🏻\n👉 https://t.me/recipes_group  "
-    )
+    async with SendBuffer(context.bot, chat_id) as out:
+        out.add(CONTENT.text("final_instructions"))
+        out.add(CONTENT.text("group_invite"))
+
+def is_valid_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Условие перехода: в сообщении похожий на email текст"""
+    email = update.message.text or ""
+    return "@" in email and "." in email
 
+@timed_handler
 async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ввода email"""
     user_id = update.effective_user.id
     email = update.message.text
     
-    if user_id in USER_STATES and USER_STATES[user_id] == "waiting_for_email":
-        if "@" in email and "." in email:
-            context.user_data['email'] = email
-            context.user_data['user_id'] = user_id
-            context.user_data['username'] = update.effective_user.username or ""
-            
-            USER_STATES.pop(user_id, None)
-            
-            tariff = context.user_data.get('tariff', '')
-            duration = "15 дней" if "15" in tariff else ("1 месяц" if "1" in tariff else "3 месяца")
-            
-            payment_msg = (
-                f"Поздравляю! Подписка успешно оформлена на **{duration}** 🥳\n\n"
-                "Ура! Ты в проекте! Прежде чем начать, давай ообсудим пару организационных моментов⤵️\n\n"
-                "1️⃣ Вступи в чат ,где мы общаемся: https://t.me/plans_channel    \n"
-                "2️⃣ Активируй чат с Полиной: @your_trainer\n\n"
-                "После этого нажми кнопку ниже:"
-            )
-            
-            await update.message.reply_text(
-                payment_msg,
-                parse_mode="Markdown",
-                reply_markup=get_continue_keyboard()
-            )
-            
-            user_data_to_save = {
-                'user_id': user_id,
-                'username': update.effective_user.username or '',
-                'name': update.effective_user.first_name or '',
-                'tariff': tariff,
-                'email': email
-            }
-            save_to_google_sheets(user_data_to_save)
-            
-        else:
-            await update.message.reply_text(
-                "Пожалуйста, введите корректный email (например: polina@mail.ru)\n"
-                "Или нажмите кнопку 'Отмена':",
-                reply_markup=get_cancel_keyboard()
-            )
+    context.user_data['email'] = email
+    context.user_data['user_id'] = user_id
+    context.user_data['username'] = update.effective_user.username or ""
+    
+    tariff = USER_STATES.get_data(user_id).get('tariff', '')
+    duration = "15 дней" if "15" in tariff else ("1 месяц" if "1" in tariff else "3 месяца")
+    
+    # Заявка сохраняется на диск до ответа: после перезапуска она будет дописана в таблицу
+    user_data_to_save = {
+        'user_id': user_id,
+        'username': update.effective_user.username or '',
+        'name': update.effective_user.first_name or '',
+        'tariff': tariff,
+        'email': email
+    }
+    await save_to_google_sheets(user_data_to_save, key=f"{user_id}:{update.update_id}")
+    
+    payment_msg = CONTENT.text("payment_success", duration=duration)
+    
+    await update.message.reply_text(
+        payment_msg,
+        parse_mode="Markdown",
+        reply_markup=get_continue_keyboard()
+    )
+
+@timed_handler
+async def handle_invalid_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Некорректный email: остаемся в ожидании ввода"""
+    await update.message.reply_text(
+        CONTENT.text("invalid_email"),
+        reply_markup=get_cancel_keyboard()
+    )
 
+@timed_handler
+async def handle_unknown_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение, для которого в воронке нет перехода"""
+    await update.message.reply_text(
+        CONTENT.text("unknown_message"),
+        reply_markup=get_start_keyboard()
+    )
+
+@timed_handler
+async def send_project_description_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправка описания проекта из текстового сообщения"""
+    await send_project_texts(context.bot, update.message.chat_id)
+
+# === ВОРОНКА: СОСТОЯНИЯ И ПЕРЕХОДЫ ===
+WAITING_FOR_EMAIL = "waiting_for_email"
+
+# (состояние, событие, обработчик, новое состояние[, условие])
+# Событие: callback_data кнопки, команда ("/start") или ее текст, ключевое слово,
+# либо общее событие "text"/"command"/"callback", если точного перехода нет
+FUNNEL = FunnelMachine(
+    states=[WAITING_FOR_EMAIL],
+    keywords={"проект": "project_request", "хочу": "project_request"},
+    store=USER_STATES,
+    transitions=[
+        # Команды (меню слева от поля ввода) и такие же текстовые сообщения
+        (ANY, "/start", start, STAY),
+        (ANY, "/menu", menu_command, STAY),
+        (ANY, "/help", help_command, STAY),
+        (ANY, "/project", project_command, STAY),
+        (ANY, "/tariffs", tariffs_command, STAY),
+        (ANY, "/reviews", reviews_command, STAY),
+
+        # Старт -> описание проекта -> тарифы / отзывы
+        (ANY, "want_project", send_project_description, STAY),
+        (ANY, "project_request", send_project_description_from_message, STAY),
+        (ANY, "tariffs", send_tariffs, STAY),
+        (ANY, "reviews", send_reviews, STAY),
+        (ANY, "reviews_page_*", handle_reviews_page, STAY),
+        (ANY, "back_to_main", handle_back, STAY),
+
+        # Выбор тарифа -> email -> продолжить
+        (ANY, "tariff_15", handle_tariff_selection, WAITING_FOR_EMAIL),
+        (ANY, "tariff_30", handle_tariff_selection, WAITING_FOR_EMAIL),
+        (ANY, "tariff_90", handle_tariff_selection, WAITING_FOR_EMAIL),
+        (WAITING_FOR_EMAIL, "text", handle_email_input, IDLE, is_valid_email),
+        (WAITING_FOR_EMAIL, "text", handle_invalid_email, STAY),
+        (ANY, "cancel", handle_cancel, IDLE),
+        (ANY, "continue", handle_continue, STAY),
+
+        (ANY, "text", handle_unknown_message, STAY),
+    ]
+)
+
+@timed_handler
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех callback запросов"""
     query = update.callback_query
-    data = query.data
-    
-    handlers = {
-        'want_project': send_project_description,
-        'tariffs': send_tariffs,
-        'reviews': send_reviews,
-        'tariff_15': lambda u, c: handle_tariff_selection(u, c, 'tariff_15'),
-        'tariff_30': lambda u, c: handle_tariff_selection(u, c, 'tariff_30'),
-        'tariff_90': lambda u, c: handle_tariff_selection(u, c, 'tariff_90'),
-        'back_to_main': handle_back,
-        'cancel': handle_cancel,
-        'continue': handle_continue
-    }
+    data = query.data or ""
     
-    handler = handlers.get(data)
-    if handler:
-        await handler(update, context)
-    else:
+    if not await FUNNEL.dispatch(update, context, FUNNEL.callback_event(data), "callback"):
         await query.answer(f"Неизвестная команда: {data}")
 
+@timed_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик текстовых сообщений"""
-    user_id = update.effective_user.id
-    
-    if user_id in USER_STATES and USER_STATES[user_id] == "waiting_for_email":
-        await handle_email_input(update, context)
-    else:
-        text = update.message.text.lower()
-        
-        if text == "/start":
-            await start(update, context)
-        elif text == "/menu":
-            await menu_command(update, context)
-        elif text == "/help":
-            await help_command(update, context)
-        elif text == "/project":
-            await project_command(update, context)
-        elif text == "/tariffs":
-            await tariffs_command(update, context)
-        elif text == "/reviews":
-            await reviews_command(update, context)
-        elif "проект" in text or "хочу" in text:
-            await send_project_description_from_message(update, context)
-        else:
-            await update.message.reply_text(
-                "Я не понял ваше сообщение. Используйте меню слева от поля ввода или команды:\n"
-                "/start - Начать\n"
-                "/menu - Меню\n"
-                "/help - Помощь",
-                reply_markup=get_start_keyboard()
-            )
-
-async def send_project_description_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправка описания проекта из текстового сообщения"""
-    desc = (
-        "Проект POLINAFIT- это комплексная работа,где важно абсолютно всё! Режим питания,тренировки,"
-        "поддержка от участниц проекта и лично меня! Это то, место где я помогу тебе дойти до результата, "
-        "доведу тебя за ручку до твоей цели, место где ты не откатишься назад и не потеряешь результат, "
-        "если случились непредвиденные обстоятельства (отпуск,стресс,травмы,болезнь итд)"
-    )
-    
-    await update.message.reply_text(desc)
-    
-    features = (
-        "Что входит в проект:\n\n"
-        "🤍 Тренировки для любого уровня подготовки дома или в зале:\n"
-        "— легкие , для тех кто только начинает\n"
-        "— средней сложности, для тех кто уже занимается\n"
-        "— интенсивные, для тех кто тренируется регулярно и хочет прогрессировать и готов к нагрузкам\n\n"
-        "🤍 Питание:\n"
-        "индивидуальный расчет КБЖУ, исходя из ваших особенностей, активности и образа жизни, "
-        "анализ динамики и изменения расчета по необходимости большие сборники завтраков,обедов и ужинов "
-        "с указанием КБЖУ каждого блюда , для того чтобы тебе было легче подбирать рацион\n\n"
-        "🤍 Индивидуальная работа с отчетами:\n"
-        "2 раза в неделю проверяю лично отчеты по питанию, по необходимости вношу корректировки "
-        "для более эффективного результата поставленной цели\n"
-        "2 раза в месяц проверяю отчеты по форме,фиксируем замеры , на основе которых могу изменить "
-        "тренировочный план или норму КБЖУ\n\n"
-        "🤍 Абсолютно любая цель:\n"
-        "— снижение веса\n"
-        "— набор веса\n\n"
-        "🤍 Доступ к чату со всеми девочками участницами , там мы обсуждаем результаты,делимся эмоциями, "
-        "рецептами, просто болтаем и поддерживаем друг друга на протяжении каждого дня, заряжаемся позитивом, "
-        "настраиваемся на продуктивные дни, там ты всегда можешь задать мне интересующий тебя вопрос. "
-        "Ведь так важно знать,что ты не один и тебя всегда поддержат!🫂"
-    )
-    
-    await update.message.reply_text(features)
-    
-    await update.message.reply_text(
-        "Выбери, что хочешь узнать:",
-        reply_markup=get_main_menu_keyboard()
-    )
+    """Обработчик текстовых сообщений и команд воронки"""
+    event, kind = FUNNEL.message_event(update.message)
+    await FUNNEL.dispatch(update, context, event, kind)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
@@ -826,38 +3248,317 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if update and hasattr(update, 'callback_query') and update.callback_query:
         try:
-            await update.callback_query.answer("Произошла ошибка. Попробуйте снова.")
+            await update.callback_query.answer(CONTENT.text("error_callback"))
         except:
             pass
     elif update and update.message:
         try:
             await update.message.reply_text(
-                "Произошла ошибка. Пожалуйста, попробуйте снова или используйте /menu",
+                CONTENT.text("error_message"),
                 reply_markup=get_start_keyboard()
             )
         except Exception as e:
             logger.error(f"Не удалось отправить сообщение об ошибке: {e}")
 
+# === РАССЫЛКА КЛИЕНТАМ ===
+BROADCAST_DB = shard_path(os.environ.get("BROADCAST_DB", "broadcasts.sqlite3"))
+# Одновременных запросов рассылки; меньше connection_pool_size, чтобы ответам пользователям хватало соединений
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 4))
+BROADCAST_CHECKPOINT_EVERY = int(os.environ.get("BROADCAST_CHECKPOINT_EVERY", 50))  # результатов между записями прогресса
+BROADCAST_REPORT_BLOCKED = 20  # сколько ID заблокировавших показать в отчете
+
+class BroadcastStore:
+    """Рассылки и статус доставки каждому получателю (SQLite).
+
+    Список получателей сохраняется целиком при создании рассылки, а
+    результаты отправки записываются пачками, поэтому после перезапуска
+    рассылка продолжается с неотправленных получателей.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, admin_chat_id INTEGER NOT NULL, text TEXT, "
+            "from_chat_id INTEGER, message_id INTEGER, status TEXT NOT NULL DEFAULT 'running', "
+            "created_at REAL NOT NULL, finished_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+            "broadcast_id INTEGER NOT NULL, user_id INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'pending', "
+            "error TEXT, PRIMARY KEY (broadcast_id, user_id))"
+        )
+        self._conn.commit()
+
+    def create(self, admin_chat_id: int, user_ids: list, text: str = None,
+               from_chat_id: int = None, message_id: int = None) -> int:
+        """Создать рассылку со списком получателей. Возвращает ее id"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO broadcasts (admin_chat_id, text, from_chat_id, message_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (admin_chat_id, text, from_chat_id, message_id, time.time())
+            )
+            broadcast_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)",
+                [(broadcast_id, user_id) for user_id in user_ids]
+            )
+            self._conn.commit()
+        return broadcast_id
+
+    def get(self, broadcast_id: int):
+        with self._lock:
+            self._conn.row_factory = sqlite3.Row
+            try:
+                row = self._conn.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+            finally:
+                self._conn.row_factory = None
+        return dict(row) if row else None
+
+    def unfinished(self) -> list:
+        """ID рассылок, прерванных перезапуском, по порядку"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id").fetchall()
+        return [broadcast_id for broadcast_id, in rows]
+
+    def last(self):
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(id) FROM broadcasts").fetchone()
+        return row[0]
+
+    def pending(self, broadcast_id: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending' ORDER BY user_id",
+                (broadcast_id,)
+            ).fetchall()
+        return [user_id for user_id, in rows]
+
+    def record(self, broadcast_id: int, results: list):
+        """Сохранить результаты отправки: [(user_id, статус, ошибка), ...]"""
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE broadcast_recipients SET status = ?, error = ? WHERE broadcast_id = ? AND user_id = ?",
+                [(status, error, broadcast_id, user_id) for user_id, status, error in results]
+            )
+            self._conn.commit()
+
+    def counts(self, broadcast_id: int) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+                (broadcast_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def blocked(self, broadcast_id: int, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'blocked' LIMIT ?",
+                (broadcast_id, limit)
+            ).fetchall()
+        return [user_id for user_id, in rows]
+
+    def finish(self, broadcast_id: int, status: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ?",
+                (status, time.time(), broadcast_id)
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+class Broadcaster:
+    """Отправка рассылки всем получателям в фоне.
+
+    Несколько воркеров отправляют сообщения параллельно, а лимиты Telegram
+    соблюдает OUTBOUND: запросы идут с PRIORITY_BULK и уступают ответам
+    пользователям. Пользователи, заблокировавшие бота (Forbidden), не
+    повторяются и попадают в отчет администратору.
+    """
+
+    def __init__(self, store: BroadcastStore, concurrency: int, checkpoint_every: int):
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.broadcast_id = None
+        self.counts = collections.Counter()
+        self.started_at = None
+        self._done_before = 0  # обработано до перезапуска (для скорости)
+        self._task = None
+        self._results = []
+        self._cancelled = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def create(self, admin_chat_id: int, user_ids: list, **message) -> int:
+        return await asyncio.to_thread(self.store.create, admin_chat_id, user_ids, **message)
+
+    def start(self, bot, broadcast_id: int):
+        self.broadcast_id = broadcast_id
+        self._cancelled = False
+        self._task = asyncio.create_task(self._run(bot, broadcast_id))
+
+    async def resume(self, bot):
+        """Продолжить рассылки, прерванные перезапуском (по одной за раз)"""
+        unfinished = await asyncio.to_thread(self.store.unfinished)
+        if unfinished and not self.running:
+            logger.info(f"📣 Продолжаем рассылку #{unfinished[0]} после перезапуска")
+            self.start(bot, unfinished[0])
+
+    def cancel(self) -> bool:
+        """Остановить рассылку по команде администратора (без продолжения после перезапуска)"""
+        if not self.running:
+            return False
+        self._cancelled = True
+        self._task.cancel()
+        return True
+
+    async def stop(self):
+        """Остановка процесса: прогресс сохраняется, рассылка продолжится при следующем запуске"""
+        if self.running:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _send(self, bot, job: dict, user_id: int):
+        try:
+            if job["message_id"]:
+                await bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=job["from_chat_id"],
+                    message_id=job["message_id"],
+                    rate_limit_args=PRIORITY_BULK
+                )
+            else:
+                await bot.send_message(chat_id=user_id, text=job["text"], rate_limit_args=PRIORITY_BULK)
+            return user_id, "sent", None
+        except Forbidden as e:
+            # Бот заблокирован или аккаунт удален: повторять бесполезно
+            return user_id, "blocked", str(e)
+        except TelegramError as e:
+            logger.warning(f"⚠️ Рассылка #{job['id']}: не доставлено {user_id}: {e}")
+            return user_id, "failed", str(e)[:500]
+
+    async def _checkpoint(self):
+        results, self._results = self._results, []
+        if results:
+            await asyncio.to_thread(self.store.record, self.broadcast_id, results)
+
+    async def _run(self, bot, broadcast_id: int):
+        job = await asyncio.to_thread(self.store.get, broadcast_id)
+        recipients = iter(await asyncio.to_thread(self.store.pending, broadcast_id))
+        self.counts = collections.Counter(await asyncio.to_thread(self.store.counts, broadcast_id))
+        self.started_at = time.monotonic()
+        self._done_before = sum(self.counts.values()) - self.counts["pending"]
+        logger.info(f"📣 Рассылка #{broadcast_id}: к отправке {self.counts['pending']} из {sum(self.counts.values())}")
+
+        async def worker():
+            for user_id in recipients:
+                result = await self._send(bot, job, user_id)
+                self.counts["pending"] -= 1
+                self.counts[result[1]] += 1
+                self._results.append(result)
+                if len(self._results) >= self.checkpoint_every:
+                    await self._checkpoint()
+
+        status = "done"
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        except asyncio.CancelledError:
+            if not self._cancelled:
+                # Остановка процесса: статус остается running
+                await asyncio.shield(self._checkpoint())
+                logger.info(f"📣 Рассылка #{broadcast_id} приостановлена, осталось {self.counts['pending']}")
+                raise
+            status = "cancelled"
+        finally:
+            await asyncio.shield(self._checkpoint())
+
+        await asyncio.to_thread(self.store.finish, broadcast_id, status)
+        logger.info(f"📣 Рассылка #{broadcast_id} завершена ({status}): {dict(self.counts)}")
+        await self._report(bot, job, status)
+
+    async def _report(self, bot, job: dict, status: str):
+        blocked = await asyncio.to_thread(self.store.blocked, job["id"], BROADCAST_REPORT_BLOCKED)
+        elapsed = time.monotonic() - self.started_at
+        title = "завершена" if status == "done" else "остановлена"
+        lines = [
+            f"📣 Рассылка #{job['id']} {title} за {elapsed:.0f} сек",
+            f"✅ Доставлено: {self.counts['sent']}",
+            f"🚫 Заблокировали бота: {self.counts['blocked']}",
+            f"⚠️ Ошибки: {self.counts['failed']}",
+        ]
+        if self.counts["pending"] > 0:
+            lines.append(f"⏸ Не отправлено: {self.counts['pending']}")
+        if blocked:
+            more = " и др." if self.counts["blocked"] > len(blocked) else ""
+            lines.append("ID заблокировавших: " + ", ".join(map(str, blocked)) + more)
+        try:
+            await bot.send_message(chat_id=job["admin_chat_id"], text="\n".join(lines))
+        except TelegramError as e:
+            logger.error(f"Не удалось отправить отчет о рассылке: {e}")
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        delivered = self.counts["sent"] + self.counts["blocked"] + self.counts["failed"] - self._done_before
+        return {
+            "running": self.running,
+            "broadcast_id": self.broadcast_id,
+            "pending": self.counts["pending"],
+            "sent": self.counts["sent"],
+            "blocked": self.counts["blocked"],
+            "failed": self.counts["failed"],
+            "messages_per_second": round(delivered / elapsed, 1) if self.running and elapsed else None
+        }
+
+BROADCASTER = Broadcaster(BroadcastStore(BROADCAST_DB), BROADCAST_CONCURRENCY, BROADCAST_CHECKPOINT_EVERY)
+
+async def load_broadcast_recipients() -> list:
+    """ID клиентов из индекса, а если он еще не загружен - из колонки ID таблицы"""
+    if CUSTOMERS.loaded:
+        ids = list(CUSTOMERS.rows)
+    elif SHEET:
+        ids = (await run_sheets_call("col_values", read_customer_ids))[1:]
+    else:
+        return []
+    return sorted({int(user_id) for user_id in ids if str(user_id).isdigit()})
+
 # === АДМИН КОМАНДЫ ===
+ADMIN_ID = int(os.environ.get("ADMIN_ID", 123456789))  # Замените на ваш ID Telegram
+
+@timed_handler
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Статистика для администратора"""
-    ADMIN_ID = 123456789  # Замените на ваш ID Telegram
-    
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("Эта команда только для администратора.")
         return
     
     try:
-        if SHEET:
-            records = len(SHEET.get_all_values()) - 1
-        else:
-            records = 0
+        today = datetime.date.today().isoformat()
+        tariff_lines = "".join(
+            f"   • {title}: {STATS.by_tariff.get(title, 0)}\n" for title in TARIFF_PRICES
+        )
         
         stats_text = (
             "📊 **Статистика бота:**\n\n"
             f"✅ Бот работает\n"
-            f"👥 Всего пользователей в базе: {records}\n"
+            f"👥 Всего пользователей в базе: {STATS.total}\n"
+            f"🆕 Новых за сегодня: {STATS.signups_on(today)}\n"
+            f"💰 Тарифы:\n{tariff_lines}"
+            f"💵 Оценка выручки: {STATS.revenue} ₽\n"
             f"🤖 Состояний пользователей в памяти: {len(USER_STATES)}\n"
+            f"📝 Очередь записи в таблицу: {SHEETS_WRITER.depth}\n"
             f"🕒 Время сервера: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
             f"🌐 Health check: http://0.0.0.0:{PORT}/health"
         )
@@ -868,10 +3569,268 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка получения статистики: {e}")
         await update.message.reply_text(f"Ошибка получения статистики: {e}")
 
+@timed_handler
+async def admin_reload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Перезагрузка каталога контента без перезапуска бота"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда только для администратора.")
+        return
+    
+    reloaded, result = reload_content(force=True)
+    if reloaded:
+        await update.message.reply_text(f"🔄 Каталог контента обновлен: {result}")
+    else:
+        await update.message.reply_text(f"Каталог контента не изменен ({result}), версия {CONTENT.version}")
+
+@timed_handler
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Рассылка всем клиентам: /broadcast <текст> или ответом на сообщение (копируется с фото и форматированием)"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда только для администратора.")
+        return
+    
+    message = update.message
+    parts = message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ""
+    source = message.reply_to_message
+    
+    if not text and not source:
+        # Без текста - состояние текущей или последней рассылки
+        broadcast_id = BROADCASTER.broadcast_id or await asyncio.to_thread(BROADCASTER.store.last)
+        if not broadcast_id:
+            await message.reply_text("Рассылок еще не было.\nИспользование: /broadcast <текст> или ответом на сообщение.")
+            return
+        counts = await asyncio.to_thread(BROADCASTER.store.counts, broadcast_id)
+        state = "идет" if BROADCASTER.running else "не активна"
+        await message.reply_text(
+            f"📣 Рассылка #{broadcast_id} ({state})\n"
+            f"⏳ В очереди: {counts.get('pending', 0)}\n"
+            f"✅ Доставлено: {counts.get('sent', 0)}\n"
+            f"🚫 Заблокировали бота: {counts.get('blocked', 0)}\n"
+            f"⚠️ Ошибки: {counts.get('failed', 0)}"
+        )
+        return
+    
+    if BROADCASTER.running:
+        await message.reply_text(f"Рассылка #{BROADCASTER.broadcast_id} еще идет. Остановить: /broadcast_stop")
+        return
+    
+    try:
+        recipients = await load_broadcast_recipients()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки получателей рассылки: {e}")
+        await message.reply_text(f"Не удалось загрузить список клиентов: {e}")
+        return
+    if not recipients:
+        await message.reply_text("Нет получателей: таблица клиентов пуста или еще не подключена.")
+        return
+    
+    if source:
+        broadcast_id = await BROADCASTER.create(
+            message.chat_id, recipients, from_chat_id=source.chat_id, message_id=source.message_id
+        )
+    else:
+        broadcast_id = await BROADCASTER.create(message.chat_id, recipients, text=text)
+    BROADCASTER.start(context.bot, broadcast_id)
+    logger.info(f"📣 Администратор запустил рассылку #{broadcast_id} на {len(recipients)} получателей")
+    await message.reply_text(
+        f"📣 Рассылка #{broadcast_id} запущена: {len(recipients)} получателей.\n"
+        "Прогресс: /broadcast, остановить: /broadcast_stop"
+    )
+
+@timed_handler
+async def admin_broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Остановка текущей рассылки"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("Эта команда только для администратора.")
+        return
+    
+    if BROADCASTER.cancel():
+        await update.message.reply_text(f"⏹ Рассылка #{BROADCASTER.broadcast_id} останавливается, отчет придет следующим сообщением.")
+    else:
+        await update.message.reply_text("Сейчас рассылка не идет.")
+
+# === ПЛАВНАЯ ОСТАНОВКА И СНИМОК СОСТОЯНИЯ ===
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", 25))  # Render ждет 30 сек после SIGTERM, затем SIGKILL
+# Обновления, пришедшие во время перезапуска, по умолчанию обрабатываются новым процессом
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"
+SNAPSHOT_FILE = shard_path(os.environ.get("SNAPSHOT_FILE", "snapshot.json.gz"))
+SNAPSHOT_VERSION = 1
+
+DRAINING = False
+STOP_EVENT = asyncio.Event()  # остановка run_webhook
+SNAPSHOT_INFO = {}
+
+def force_exit(reason: str):
+    """Выход без ожидания: дописать логи и завершить процесс (заявки уже в outbox)"""
+    logger.error(f"❌ {reason}, принудительный выход")
+    stop_logging(LOG_HANDLER.listener)
+    os._exit(1)
+
+def begin_drain(application: Application, reason: str):
+    """Остановить прием обновлений; PTB дообработает начатые, затем post_shutdown"""
+    global DRAINING
+    if DRAINING:
+        force_exit(f"{reason} во время остановки")
+    DRAINING = True
+    logger.info(f"🛑 {reason}: прием обновлений остановлен, завершаем начатую работу")
+    watchdog = threading.Timer(DRAIN_TIMEOUT, force_exit, [f"Плавная остановка не завершилась за {DRAIN_TIMEOUT} сек"])
+    watchdog.daemon = True
+    watchdog.start()
+    if ROUTER:
+        ROUTER.terminate()
+    if USE_WEBHOOK:
+        STOP_EVENT.set()
+    else:
+        application.stop_running()
+
+def install_signal_handlers(application: Application):
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, begin_drain, application, signal.Signals(signum).name)
+        except (NotImplementedError, RuntimeError) as e:
+            logger.warning(f"⚠️ Не удалось установить обработчик {signum}: {e}")
+
+def take_snapshot() -> dict:
+    """Сессии и индексы, которые иначе пришлось бы собирать заново после запуска"""
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time(),
+        "customers": {
+            "rows": {user_id: number for user_id, number in CUSTOMERS.rows.items() if number},
+            "next_row": CUSTOMERS.next_row
+        } if CUSTOMERS.loaded else None,
+        "stats": {
+            "total": STATS.total,
+            "revenue": STATS.revenue,
+            "by_tariff": dict(STATS.by_tariff),
+            "by_day": dict(STATS.by_day),
+            "customers": STATS.customers
+        } if STATS.loaded else None,
+        "sessions": None
+    }
+    # Общее хранилище и SQLitePersistence и так переживают перезапуск
+    if SESSION_BACKEND == "memory":
+        deadline = time.time() - USER_STATES.ttl
+        snapshot["sessions"] = [entry for entry in USER_STATES.dump() if entry[2] > deadline]
+    return snapshot
+
+def save_snapshot():
+    started = time.perf_counter()
+    snapshot = take_snapshot()
+    tmp_path = f"{SNAPSHOT_FILE}.tmp"
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, SNAPSHOT_FILE)
+    except Exception as e:
+        logger.error(f"❌ Не удалось сохранить снимок состояния: {e}")
+        return
+    SNAPSHOT_INFO["saved"] = {
+        "sessions": len(snapshot["sessions"] or ()),
+        "customers": len((snapshot["customers"] or {}).get("rows", ())),
+        "bytes": os.path.getsize(SNAPSHOT_FILE),
+        "seconds": round(time.perf_counter() - started, 3)
+    }
+    logger.info(f"💾 Снимок состояния сохранен в {SNAPSHOT_FILE}: {SNAPSHOT_INFO['saved']}")
+
+def load_snapshot():
+    """Теплый старт: сессии сразу, индексы - до загрузки из таблицы (она их уточнит)"""
+    try:
+        with gzip.open(SNAPSHOT_FILE, "rt", encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось прочитать снимок {SNAPSHOT_FILE}: {e}")
+        return
+    finally:
+        # Снимок одноразовый: после аварийного выхода старые сессии не должны вернуться
+        with contextlib.suppress(OSError):
+            os.remove(SNAPSHOT_FILE)
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        logger.info(f"Снимок версии {snapshot.get('version')} пропущен")
+        return
+
+    sessions = snapshot.get("sessions") or []
+    if SESSION_BACKEND == "memory":
+        for user_id, state, touched_at, data in sessions:
+            USER_STATES.restore(user_id, FUNNEL.parse_state(state), touched_at, data)
+
+    customers = snapshot.get("customers")
+    if customers and not CUSTOMERS.loaded:
+        for user_id, number in customers["rows"].items():
+            CUSTOMERS.rows.setdefault(user_id, number)
+        CUSTOMERS.next_row = max(CUSTOMERS.next_row, customers["next_row"])
+
+    stats = snapshot.get("stats")
+    if stats and not STATS.loaded:
+        STATS.total = stats["total"]
+        STATS.revenue = stats["revenue"]
+        STATS.by_tariff = collections.Counter(stats["by_tariff"])
+        STATS.by_day = collections.Counter(stats["by_day"])
+        STATS.customers = {user_id: tuple(entry) for user_id, entry in stats["customers"].items()}
+
+    SNAPSHOT_INFO["loaded"] = {
+        "age_seconds": round(time.time() - snapshot["saved_at"], 1),
+        "sessions": len(sessions),
+        "customers": len((customers or {}).get("rows", ()))
+    }
+    logger.info(f"♻️ Теплый старт из снимка: {SNAPSHOT_INFO['loaded']}")
+
 # === ОСНОВНАЯ ФУНКЦИЯ С УЛУЧШЕННОЙ ОБРАБОТКОЙ ОШИБОК ===
+BACKGROUND_TASKS = set()
+
+def run_in_background(coro):
+    """Фоновая задача запуска (ссылка хранится до ее завершения)"""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
 async def post_init(application: Application):
     """Функция, которая выполняется после инициализации бота"""
-    await set_bot_commands(application)
+    global APPLICATION
+    APPLICATION = application
+    STARTUP.mark("telegram_connected")
+    install_signal_handlers(application)
+    with STARTUP.phase("snapshot"):
+        load_snapshot()
+    
+    # Не нужны для первого ответа: выполняются в фоне параллельно
+    start_sheets_warmup()
+    if not SHARD_ID:
+        # Общие для бота действия выполняет только основной процесс
+        start_keep_alive()
+        run_in_background(set_bot_commands(application))
+    
+    # При удалении сессии освобождаем и user_data пользователя
+    USER_STATES.on_evict = application.drop_user_data
+    application.job_queue.run_repeating(purge_sessions_job, interval=60, first=60)
+    # Строки копятся в очереди, пока таблица подключается (см. warm_up_sheets)
+    await SHEETS_WRITER.start()
+    # Рассылка, прерванная перезапуском, продолжается с неотправленных получателей
+    await BROADCASTER.resume(application.bot)
+    
+    if CONTENT_WATCH_INTERVAL > 0:
+        application.job_queue.run_repeating(
+            content_watch_job,
+            interval=CONTENT_WATCH_INTERVAL,
+            first=CONTENT_WATCH_INTERVAL
+        )
+    
+    if STATS_RECONCILE_INTERVAL > 0 and not SHARD_ID:
+        application.job_queue.run_repeating(
+            reconcile_stats_job,
+            interval=STATS_RECONCILE_INTERVAL,
+            first=STATS_RECONCILE_INTERVAL
+        )
+    
+    if not USE_WEBHOOK:
+        # Сразу после post_init PTB запускает getUpdates
+        STARTUP.mark("ready")
     
     # Отправляем сообщение о запуске (опционально)
     try:
@@ -880,40 +3839,280 @@ async def post_init(application: Application):
     except:
         pass
 
+async def post_shutdown(application: Application):
+    """Функция, которая выполняется при остановке бота"""
+    if SHEETS_WARMUP_TASK and not SHEETS_WARMUP_TASK.done():
+        SHEETS_WARMUP_TASK.cancel()
+    await BROADCASTER.stop()
+    await SHEETS_WRITER.stop()
+    if isinstance(application.persistence, SQLitePersistence):
+        application.persistence.close()
+    save_snapshot()
+    logger.info("👋 Бот остановлен")
+
+# === РАЗДАЧА ОБНОВЛЕНИЙ ПО ШАРДАМ ===
+SHARD_READY_TIMEOUT = 60  # секунд на запуск дочерних процессов
+SHARD_CHECK_INTERVAL = 5
+
+def shard_for(update: Update) -> int:
+    """Шард пользователя: все обновления одного пользователя идут в один процесс.
+
+    Админ всегда попадает в шард 0: там пишутся заявки в таблицу и полная статистика.
+    """
+    user = update.effective_user
+    if not user or user.id == ADMIN_ID:
+        return 0
+    return user.id % BOT_WORKERS
+
+class ShardRouter:
+    """Дочерние процессы бота и пересылка им webhook-обновлений.
+
+    Шард k - тот же bot.py с BOT_SHARD=k, слушающий 127.0.0.1:PORT+k.
+    Основной процесс обрабатывает свою долю пользователей сам, остальные
+    обновления пересылает как есть. Если шард не ответил, Telegram получает
+    503 и повторит доставку. Упавший процесс перезапускается.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.processes = {}
+        self.forwarded = collections.Counter()
+        self.errors = collections.Counter()
+        self.restarts = 0
+        self._client = None
+        self._task = None
+        self._terminated = False
+
+    def _url(self, shard: int, path: str) -> str:
+        return f"http://127.0.0.1:{PORT + shard}{path}"
+
+    def _spawn(self, shard: int):
+        env = dict(os.environ, BOT_SHARD=str(shard), PORT=str(PORT + shard), BOT_PARENT_PID=str(os.getpid()))
+        self.processes[shard] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        logger.info(f"🧩 Запущен шард {shard} (pid {self.processes[shard].pid}, порт {PORT + shard})")
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=30)
+        for shard in range(1, self.workers):
+            self._spawn(shard)
+        await self._wait_ready()
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _wait_ready(self):
+        deadline = time.monotonic() + SHARD_READY_TIMEOUT
+        for shard in range(1, self.workers):
+            while time.monotonic() < deadline:
+                try:
+                    if (await self._client.get(self._url(shard, "/ping"))).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.2)
+            else:
+                logger.warning(f"⚠️ Шард {shard} не ответил за {SHARD_READY_TIMEOUT} сек")
+
+    async def _supervise(self):
+        while True:
+            await asyncio.sleep(SHARD_CHECK_INTERVAL)
+            for shard, process in list(self.processes.items()):
+                if process.poll() is not None:
+                    logger.error(f"❌ Шард {shard} завершился с кодом {process.returncode}, перезапуск")
+                    self.restarts += 1
+                    self._spawn(shard)
+
+    async def forward(self, shard: int, body: bytes) -> bool:
+        """Переслать обновление шарду. False - шард недоступен"""
+        try:
+            response = await self._client.post(
+                self._url(shard, WEBHOOK_PATH),
+                content=body,
+                headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET, "Content-Type": "application/json"}
+            )
+        except httpx.HTTPError as e:
+            self.errors[shard] += 1
+            logger.warning(f"⚠️ Шард {shard} недоступен: {e}")
+            return False
+        if response.status_code != 200:
+            self.errors[shard] += 1
+            return False
+        self.forwarded[shard] += 1
+        return True
+
+    def terminate(self):
+        """SIGTERM всем шардам без перезапуска: они останавливаются параллельно с основным процессом"""
+        if self._terminated:
+            # Повторный SIGTERM шард считает командой на немедленный выход
+            return
+        self._terminated = True
+        if self._task:
+            self._task.cancel()
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+    async def stop(self):
+        self.terminate()
+        for shard, process in self.processes.items():
+            try:
+                # Шард сам дообрабатывает свои обновления (begin_drain)
+                await asyncio.to_thread(process.wait, DRAIN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"⚠️ Шард {shard} не остановился за {DRAIN_TIMEOUT} сек, kill")
+                process.kill()
+        if self._client:
+            await self._client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "alive": sum(1 for process in self.processes.values() if process.poll() is None) + 1,
+            "forwarded": {str(shard): count for shard, count in sorted(self.forwarded.items())},
+            "errors": {str(shard): count for shard, count in sorted(self.errors.items())},
+            "restarts": self.restarts
+        }
+
+ROUTER = None  # ShardRouter основного процесса при BOT_WORKERS > 1
+
+async def watch_parent():
+    """Дочерний шард завершается вместе с основным процессом"""
+    parent = int(os.environ.get("BOT_PARENT_PID", 0))
+    while not parent or os.getppid() == parent:
+        await asyncio.sleep(SHARD_CHECK_INTERVAL)
+    begin_drain(APPLICATION, f"Основной процесс {parent} завершился")
+
+def shard_stats() -> dict:
+    if ROUTER:
+        return {"id": SHARD_ID, **ROUTER.stats()}
+    return {"id": SHARD_ID, "workers": BOT_WORKERS}
+
+# === РЕЖИМ WEBHOOK ===
+def make_webhook_route(application: Application):
+    """Обработчик POST-запросов Telegram на WEBHOOK_PATH"""
+    async def telegram_webhook(request: HttpRequest):
+        if DRAINING:
+            # Telegram повторит доставку, обновление получит новый процесс
+            return 503, "text/plain", b'shutting down'
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        # Сравнение за постоянное время: по времени ответа секрет не подобрать
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning("⚠️ Webhook-запрос с неверным секретным токеном отклонен")
+            return 403, "text/plain", b'forbidden'
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception as e:
+            logger.warning(f"⚠️ Некорректное обновление в webhook: {e}")
+            return 400, "text/plain", b'bad request'
+        shard = shard_for(update) if ROUTER else 0
+        if shard:
+            if await ROUTER.forward(shard, request.body):
+                return 200, "text/plain", b'ok'
+            return 503, "text/plain", b'shard unavailable'
+        await application.update_queue.put(update)
+        return 200, "text/plain", b'ok'
+    return telegram_webhook
+
+async def run_webhook(application: Application):
+    """Запуск бота в режиме webhook на общем с health check порту"""
+    global ROUTER
+    HTTP_ROUTES[("POST", WEBHOOK_PATH)] = make_webhook_route(application)
+    try:
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        
+        if SHARD_ID:
+            # Дочерний шард получает обновления от основного процесса
+            await application.start()
+            STARTUP.mark("ready")
+            logger.info(f"🧩 Шард {SHARD_ID}/{BOT_WORKERS} принимает обновления на порту {PORT}")
+            run_in_background(watch_parent())
+            await STOP_EVENT.wait()
+            return
+        
+        if BOT_WORKERS > 1:
+            ROUTER = ShardRouter(BOT_WORKERS)
+            await ROUTER.start()
+        
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES
+        )
+        await application.start()
+        STARTUP.mark("ready")
+        logger.info(f"🔗 Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        
+        # Работаем до SIGTERM (см. begin_drain)
+        await STOP_EVENT.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        if ROUTER:
+            await ROUTER.stop()
+
 def main():
     """Основная функция запуска бота с улучшенной стабильностью"""
     max_retries = 5
     retry_delay = 30  # секунд
     
+    # Один event loop на все попытки: порт health check занят до подключения к Telegram
+    # и отвечает во время пауз между попытками (иначе Render сочтет сервис упавшим)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with STARTUP.phase("http_server"):
+        loop.run_until_complete(start_http_server())
+    
     for attempt in range(max_retries):
         try:
             logger.info("=" * 60)
             logger.info(f"🤖 ПОПЫТКА ЗАПУСКА БОТА #{attempt + 1}")
             logger.info(f"Токен: {TOKEN[:10]}...")
             logger.info(f"Порт: {PORT}")
-            logger.info(f"Google Sheets: {'Подключен' if SHEET else 'Не подключен'}")
+            logger.info(f"Шард: {SHARD_ID} из {BOT_WORKERS}, сессии: {SESSION_BACKEND}")
+            if BOT_WORKERS > 1 and not USE_WEBHOOK:
+                logger.warning("⚠️ BOT_WORKERS > 1 работает только в режиме webhook, запускается один процесс")
+            logger.info(f"Google Sheets: подключение в фоне после запуска ({SHEETS_BACKEND})")
             logger.info(f"Время старта: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
             logger.info("=" * 60)
             
             # Создаем Application с улучшенными настройками
-            application = Application.builder() \
+            builder = Application.builder()
+            if SESSION_BACKEND == "sqlite":
+                builder = builder.persistence(SQLitePersistence(SESSION_DB, SESSION_FLUSH_INTERVAL))
+            if TELEGRAM_API_URL:
+                builder = builder.base_url(TELEGRAM_API_URL)
+            
+            STARTUP.mark("application_build")
+            application = builder \
                 .token(TOKEN) \
                 .post_init(post_init) \
-                .connection_pool_size(8) \
-                .pool_timeout(120) \
-                .connect_timeout(120) \
-                .read_timeout(120) \
-                .write_timeout(120) \
+                .post_shutdown(post_shutdown) \
+                .rate_limiter(OUTBOUND) \
+                .concurrent_updates(UPDATE_PROCESSOR) \
+                .request(InstrumentedRequest(
+                    connection_pool_size=8,
+                    pool_timeout=120,
+                    connect_timeout=120,
+                    read_timeout=120,
+                    write_timeout=120
+                )) \
                 .build()
             
+            # Продление сессии пользователя до основных обработчиков
+            application.add_handler(TypeHandler(Update, touch_session), group=-1)
+            
             # Добавляем обработчики команд меню
-            application.add_handler(CommandHandler("start", start))
-            application.add_handler(CommandHandler("menu", menu_command))
-            application.add_handler(CommandHandler("help", help_command))
-            application.add_handler(CommandHandler("project", project_command))
-            application.add_handler(CommandHandler("tariffs", tariffs_command))
-            application.add_handler(CommandHandler("reviews", reviews_command))
+            application.add_handler(CommandHandler(FUNNEL.commands, handle_message))
             application.add_handler(CommandHandler("stats", admin_stats))
+            application.add_handler(CommandHandler("reload", admin_reload))
+            application.add_handler(CommandHandler("broadcast", admin_broadcast))
+            application.add_handler(CommandHandler("broadcast_stop", admin_broadcast_stop))
             
             # Обработчик inline кнопок
             application.add_handler(CallbackQueryHandler(handle_callback_query))
@@ -928,12 +4127,16 @@ def main():
             logger.info("🔧 Конфигурация оптимизирована для Render Free Tier")
             logger.info("📈 Используйте uptime-мониторинг для лучшей доступности")
             
+            if USE_WEBHOOK:
+                loop.run_until_complete(run_webhook(application))
+                break
+            
             # Запускаем бота с улучшенными параметрами
             application.run_polling(
-                drop_pending_updates=True,
+                drop_pending_updates=DROP_PENDING_UPDATES,
                 allowed_updates=Update.ALL_TYPES,
                 close_loop=False,
-                stop_signals=[],  # Игнорируем сигналы остановки
+                stop_signals=[],  # SIGTERM/SIGINT обрабатывает begin_drain (см. post_init)
                 pool_timeout=120,
                 connect_timeout=120,
                 read_timeout=120,
@@ -948,11 +4151,15 @@ def main():
             
             if attempt < max_retries - 1:
                 logger.info(f"⏳ Повторная попытка через {retry_delay} секунд...")
-                time.sleep(retry_delay)
+                loop.run_until_complete(asyncio.sleep(retry_delay))
                 retry_delay *= 2  # Экспоненциальная задержка
             else:
                 logger.error("🚫 Все попытки запуска исчерпаны. Бот остановлен.")
                 raise
+    
+    loop.run_until_complete(stop_http_server())
+
+STARTUP.mark("module_loaded")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
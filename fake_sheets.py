@@ -0,0 +1,161 @@
+"""Локальная замена листа Google Sheets для тестов и бенчмарков записи.
+
+FakeWorksheet повторяет методы gspread.Worksheet, которыми пользуется bot.py,
+хранит строки в памяти и умеет имитировать задержку сети, случайные ошибки,
+превышение квоты (429) и полный отказ сервиса (503).
+
+В bot.py подключается переменной окружения SHEETS_BACKEND=fake
+(параметры: FAKE_SHEETS_LATENCY, FAKE_SHEETS_JITTER в мс,
+FAKE_SHEETS_ERROR_RATE от 0 до 1, FAKE_SHEETS_QUOTA запросов в минуту).
+"""
+import collections
+import os
+import random
+import re
+import threading
+import time
+
+from gspread.exceptions import APIError
+
+HEADERS = ["ID", "Username", "Имя", "Рост", "Вес", "Калораж", "Дата", "Тариф", "Email"]
+
+
+class FakeResponse:
+    """Ответ HTTP, достаточный для конструктора gspread APIError"""
+
+    def __init__(self, code: int, message: str):
+        self.status_code = code
+        self.text = message
+        self._error = {"code": code, "message": message, "status": message}
+
+    def json(self):
+        return {"error": self._error}
+
+
+def a1_to_row_col(label: str):
+    """'B12' -> (12, 2)"""
+    match = re.fullmatch(r"([A-Z]+)(\d+)", label.upper())
+    if not match:
+        raise ValueError(f"Некорректная ячейка: {label}")
+    letters, row = match.groups()
+    col = 0
+    for letter in letters:
+        col = col * 26 + ord(letter) - ord("A") + 1
+    return int(row), col
+
+
+class FakeWorksheet:
+    """Лист в памяти с поведением, похожим на gspread.Worksheet"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 quota_per_minute: int = 0, headers=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_per_minute = quota_per_minute
+        self.down = False
+        self.rows = [list(headers)] if headers else []
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._recent = collections.deque()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            latency=float(os.environ.get("FAKE_SHEETS_LATENCY", 300)) / 1000,
+            jitter=float(os.environ.get("FAKE_SHEETS_JITTER", 100)) / 1000,
+            error_rate=float(os.environ.get("FAKE_SHEETS_ERROR_RATE", 0)),
+            quota_per_minute=int(os.environ.get("FAKE_SHEETS_QUOTA", 0)),
+            headers=HEADERS
+        )
+
+    def _request(self, operation: str):
+        """Имитация сетевого запроса: задержка, отказ, квота, случайная ошибка"""
+        self.calls[operation] += 1
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if self.down:
+            self.errors[operation] += 1
+            raise APIError(FakeResponse(503, "The service is currently unavailable."))
+
+        if self.quota_per_minute:
+            now = time.monotonic()
+            with self._lock:
+                while self._recent and now - self._recent[0] > 60:
+                    self._recent.popleft()
+                if len(self._recent) >= self.quota_per_minute:
+                    self.errors[operation] += 1
+                    raise APIError(FakeResponse(429, "Quota exceeded for quota metric 'Write requests'."))
+                self._recent.append(now)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors[operation] += 1
+            raise APIError(FakeResponse(500, "Internal error encountered."))
+
+    # --- чтение ---
+
+    def row_values(self, row: int, **kwargs) -> list:
+        self._request("row_values")
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col: int, **kwargs) -> list:
+        self._request("col_values")
+        with self._lock:
+            values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self, **kwargs) -> list:
+        self._request("get_all_values")
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    # --- запись ---
+
+    def _append(self, values: list) -> dict:
+        """Добавление строк в конец; ответ в формате spreadsheets.values.append"""
+        with self._lock:
+            start = len(self.rows) + 1
+            self.rows.extend([str(value) for value in row] for row in values)
+            end = len(self.rows)
+        width = max((len(row) for row in values), default=1)
+        last_col = chr(ord("A") + width - 1)
+        return {"updates": {"updatedRange": f"Sheet1!A{start}:{last_col}{end}", "updatedRows": len(values)}}
+
+    def append_row(self, values: list, **kwargs) -> dict:
+        self._request("append_row")
+        return self._append([values])
+
+    def append_rows(self, values: list, **kwargs) -> dict:
+        self._request("append_rows")
+        return self._append(values)
+
+    def batch_update(self, data: list, **kwargs):
+        """Запись диапазонов вида {'range': 'A5:I5', 'values': [[...]]}"""
+        self._request("batch_update")
+        with self._lock:
+            for item in data:
+                start_row, start_col = a1_to_row_col(item["range"].split(":")[0])
+                for row_offset, values in enumerate(item["values"]):
+                    row_index = start_row + row_offset - 1
+                    while len(self.rows) <= row_index:
+                        self.rows.append([])
+                    row = self.rows[row_index]
+                    for col_offset, value in enumerate(values):
+                        col_index = start_col + col_offset - 1
+                        while len(row) <= col_index:
+                            row.append("")
+                        row[col_index] = str(value)
+
+    # --- для проверок ---
+
+    def data_rows(self) -> list:
+        """Строки без заголовка (без имитации сети)"""
+        with self._lock:
+            return [list(row) for row in self.rows[1:]]
@@ -0,0 +1,224 @@
+"""Локальная имитация Telegram Bot API для нагрузочного тестирования bot.py.
+
+Сервер принимает запросы вида POST /bot<token>/<method>, отдает обновления
+через getUpdates или доставляет их на webhook бота и записывает все вызовы
+(метод, чат, время обработки), чтобы драйвер из loadtest.py мог ждать ответы.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import time
+import urllib.parse
+
+import httpx
+
+# Параметры, которые PTB передает в виде JSON-строк
+JSON_PARAMS = {"reply_markup", "media", "allowed_updates", "commands", "entities", "caption_entities"}
+
+BOT_USER = {
+    "id": 100000001,
+    "is_bot": True,
+    "first_name": "LoadTestBot",
+    "username": "loadtest_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False
+}
+
+
+def parse_params(body: bytes, content_type: str) -> dict:
+    """Разбор параметров запроса PTB (form-urlencoded или JSON)"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+
+    params = {}
+    for name, value in urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True):
+        if name in JSON_PARAMS:
+            value = json.loads(value)
+        elif name in ("chat_id", "message_id", "offset", "limit", "timeout") and value.lstrip("-").isdigit():
+            value = int(value)
+        params[name] = value
+    return params
+
+
+class FakeTelegramAPI:
+    """Минимальный Bot API: getUpdates/webhook на входе, send*/edit* на выходе"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.call_times = collections.defaultdict(list)
+        self.listeners = []  # функции (chat_id, method, params, result)
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.ready = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._unique_ids = {}  # URL или file_id -> file_unique_id
+        self._pending = []
+        self._new_updates = asyncio.Event()
+        self._server = None
+        self._client = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._client = httpx.AsyncClient(timeout=30)
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._client:
+            await self._client.aclose()
+
+    # --- входящие обновления ---
+
+    def next_update_id(self) -> int:
+        return next(self._update_ids)
+
+    async def push_update(self, update: dict):
+        """Передать обновление боту (webhook, если он установлен, иначе getUpdates)"""
+        if self.webhook_url:
+            response = await self._client.post(
+                self.webhook_url,
+                json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret or ""}
+            )
+            response.raise_for_status()
+            return
+        self._pending.append(update)
+        self._new_updates.set()
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = params.get("offset")
+        if offset:
+            self._pending = [update for update in self._pending if update["update_id"] >= offset]
+        if not self._pending:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=params.get("timeout") or 0)
+            except asyncio.TimeoutError:
+                pass
+        return self._pending[:params.get("limit") or 100]
+
+    # --- исходящие вызовы бота ---
+
+    def _message(self, chat_id, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER
+        }
+        message.update({key: value for key, value in fields.items() if value is not None})
+        return message
+
+    def _photo(self, source=None) -> list:
+        # Как в Telegram: у каждого сообщения свой file_id, а file_unique_id
+        # один для одного изображения (URL или file_id, по которому его прислали)
+        file_id = f"fake-photo-{next(self._file_ids)}"
+        key = source or file_id
+        if key not in self._unique_ids:
+            self._unique_ids[key] = f"fake-unique-{next(self._file_ids)}"
+        self._unique_ids[file_id] = self._unique_ids[key]
+        return [{"file_id": file_id, "file_unique_id": self._unique_ids[key], "width": 800, "height": 800}]
+
+    async def _call(self, method: str, params: dict):
+        chat_id = params.get("chat_id")
+        markup = params.get("reply_markup")
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            self.ready.set()
+            return await self._get_updates(params)
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            self.ready.set()
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = None
+            if params.get("drop_pending_updates") in (True, "true", "True"):
+                self._pending.clear()
+            return True
+        if method == "sendMessage":
+            return self._message(chat_id, text=params.get("text"), reply_markup=markup)
+        if method == "sendPhoto":
+            return self._message(chat_id, photo=self._photo(params.get("photo")), caption=params.get("caption"), reply_markup=markup)
+        if method == "sendMediaGroup":
+            group_id = str(next(self._file_ids))
+            return [self._message(chat_id, photo=self._photo(item.get("media")), media_group_id=group_id) for item in params.get("media", [])]
+        if method in ("editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup"):
+            fields = {"message_id": params.get("message_id"), "reply_markup": markup, "edit_date": int(time.time())}
+            if method == "editMessageText":
+                fields["text"] = params.get("text")
+            elif method == "editMessageCaption":
+                fields["caption"] = params.get("caption")
+                fields["photo"] = self._photo()
+            elif method == "editMessageMedia":
+                fields["photo"] = self._photo(params.get("media", {}).get("media"))
+                fields["caption"] = params.get("media", {}).get("caption")
+            message = self._message(chat_id, **fields)
+            message["message_id"] = params.get("message_id")
+            return message
+        return True
+
+    def _notify(self, method: str, params: dict, result):
+        chat_id = params.get("chat_id")
+        if chat_id is None:
+            return
+        for listener in self.listeners:
+            listener(chat_id, method, params, result)
+
+    # --- HTTP ---
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                method = target.split("?", 1)[0].rsplit("/", 1)[-1]
+                started = time.perf_counter()
+                params = parse_params(body, headers.get("content-type", ""))
+                if self.latency and method != "getUpdates":
+                    await asyncio.sleep(self.latency)
+                result = await self._call(method, params)
+                self.calls[method] += 1
+                self.call_times[method].append(time.perf_counter() - started)
+                self._notify(method, params, result)
+
+                payload = json.dumps({"ok": True, "result": result}).encode("utf-8")
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1")
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            # CancelledError: сервер останавливается, пока бот держит long polling
+            pass
+        finally:
+            writer.close()
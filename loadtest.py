@@ -0,0 +1,272 @@
+"""Нагрузочный тест bot.py на локальной имитации Bot API.
+
+Запускает FakeTelegramAPI, поднимает bot.py отдельным процессом (направив его
+на фейковый API через TELEGRAM_API_URL) и прогоняет виртуальных пользователей
+по воронке /start -> want_project -> tariffs -> tariff_30 -> email -> continue.
+В конце печатает p50/p95/p99 по шагам, пропускную способность и число вызовов API.
+
+Пример:
+    python loadtest.py --users 200 --concurrency 50
+    python loadtest.py --users 200 --concurrency 50 --mode webhook
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from fake_telegram import FakeTelegramAPI
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+FIRST_USER_ID = 500000000
+
+
+def has_button(callback_data: str):
+    """Условие: пришло сообщение с кнопкой callback_data"""
+    def check(method, params, result):
+        markup = params.get("reply_markup") or {}
+        return any(
+            button.get("callback_data") == callback_data
+            for row in markup.get("inline_keyboard", [])
+            for button in row
+        )
+    return check
+
+
+def has_text(fragment: str):
+    """Условие: пришло сообщение, текст которого содержит fragment"""
+    def check(method, params, result):
+        return fragment in (params.get("text") or params.get("caption") or "")
+    return check
+
+
+# Шаг воронки: (название, тип обновления, данные, условие завершения шага)
+FUNNEL = [
+    ("start", "message", "/start", has_button("want_project")),
+    ("want_project", "callback", "want_project", has_button("tariffs")),
+    ("tariffs", "callback", "tariffs", has_button("tariff_30")),
+    ("tariff_30", "callback", "tariff_30", has_button("cancel")),
+    ("email", "message", "user{user_id}@example.com", has_button("continue")),
+    ("continue", "callback", "continue", has_text("recipes_group")),
+]
+
+
+class Inbox:
+    """Исходящие сообщения бота в один чат"""
+
+    def __init__(self):
+        self.messages = []  # (method, params, result)
+        self.changed = asyncio.Condition()
+
+    async def deliver(self, method, params, result):
+        async with self.changed:
+            self.messages.append((method, params, result))
+            self.changed.notify_all()
+
+    async def wait_for(self, condition, since: int, timeout: float):
+        """Дождаться сообщения (начиная с индекса since), удовлетворяющего условию"""
+        async def scan():
+            async with self.changed:
+                while True:
+                    for method, params, result in self.messages[since:]:
+                        if condition(method, params, result):
+                            return result
+                    await self.changed.wait()
+        return await asyncio.wait_for(scan(), timeout)
+
+
+class SimulatedUser:
+    """Виртуальный пользователь, проходящий воронку"""
+
+    def __init__(self, api: FakeTelegramAPI, user_id: int, inbox: Inbox):
+        self.api = api
+        self.user_id = user_id
+        self.inbox = inbox
+        self.sent_messages = 0
+        self.user = {
+            "id": user_id,
+            "is_bot": False,
+            "first_name": f"User{user_id}",
+            "username": f"user{user_id}"
+        }
+        self.last_bot_message = None
+
+    def _message_update(self, text: str) -> dict:
+        self.sent_messages += 1
+        message = {
+            "message_id": self.sent_messages,
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private", "first_name": self.user["first_name"]},
+            "from": self.user,
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self.api.next_update_id(), "message": message}
+
+    def _callback_update(self, data: str) -> dict:
+        return {
+            "update_id": self.api.next_update_id(),
+            "callback_query": {
+                "id": f"{self.user_id}-{self.api.next_update_id()}",
+                "from": self.user,
+                "chat_instance": str(self.user_id),
+                "data": data,
+                "message": self.last_bot_message
+            }
+        }
+
+    async def run(self, timeout: float, results: dict, errors: collections.Counter):
+        for name, kind, data, condition in FUNNEL:
+            if kind == "message":
+                update = self._message_update(data.format(user_id=self.user_id))
+            else:
+                update = self._callback_update(data)
+
+            since = len(self.inbox.messages)
+            started = time.perf_counter()
+            try:
+                await self.api.push_update(update)
+                result = await self.inbox.wait_for(condition, since, timeout)
+            except Exception:
+                errors[name] += 1
+                return
+            results[name].append(time.perf_counter() - started)
+            if isinstance(result, dict):
+                self.last_bot_message = result
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+def wait_for_http(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"Бот не ответил на {url} за {timeout} сек")
+
+
+async def run_load(args) -> dict:
+    api = FakeTelegramAPI(port=args.api_port, latency=args.api_latency / 1000)
+    inboxes = collections.defaultdict(Inbox)
+
+    def on_send(chat_id, method, params, result):
+        asyncio.get_running_loop().create_task(inboxes[chat_id].deliver(method, params, result))
+
+    api.listeners.append(on_send)
+    await api.start()
+
+    bot_process = None
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    try:
+        if not args.no_spawn:
+            env = dict(
+                os.environ,
+                BOT_TOKEN="123456:LOADTEST",
+                TELEGRAM_API_URL=api.base_url,
+                PORT=str(args.bot_port),
+                BOT_MODE=args.mode,
+                WEBHOOK_URL=f"http://127.0.0.1:{args.bot_port}" if args.mode == "webhook" else ""
+            )
+            bot_process = subprocess.Popen(
+                [sys.executable, BOT_SCRIPT],
+                cwd=workdir,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+            await asyncio.to_thread(wait_for_http, f"http://127.0.0.1:{args.bot_port}/ping", 60)
+        await asyncio.wait_for(api.ready.wait(), timeout=60)
+
+        results = collections.defaultdict(list)
+        errors = collections.Counter()
+        semaphore = asyncio.Semaphore(args.concurrency)
+        calls_before = sum(api.calls.values())
+
+        async def one_user(index: int):
+            async with semaphore:
+                user_id = FIRST_USER_ID + index
+                await SimulatedUser(api, user_id, inboxes[user_id]).run(args.timeout, results, errors)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user(i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+
+        updates = sum(len(values) for values in results.values()) + sum(errors.values())
+        return {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "mode": args.mode,
+            "elapsed_seconds": round(elapsed, 3),
+            "updates_per_second": round(updates / elapsed, 1) if elapsed else 0,
+            "api_calls": sum(api.calls.values()) - calls_before,
+            "api_calls_per_user": round((sum(api.calls.values()) - calls_before) / max(1, args.users), 1),
+            "calls_by_method": {
+                method: count for method, count in api.calls.items() if method != "getUpdates"
+            },
+            "steps": {
+                name: {
+                    "count": len(results[name]),
+                    "errors": errors[name],
+                    "p50_ms": round(percentile(results[name], 0.50) * 1000, 1) if results[name] else None,
+                    "p95_ms": round(percentile(results[name], 0.95) * 1000, 1) if results[name] else None,
+                    "p99_ms": round(percentile(results[name], 0.99) * 1000, 1) if results[name] else None
+                }
+                for name, *_ in FUNNEL
+            }
+        }
+    finally:
+        if bot_process:
+            bot_process.terminate()
+            try:
+                await asyncio.to_thread(bot_process.wait, 10)
+            except subprocess.TimeoutExpired:
+                bot_process.kill()
+        await api.stop()
+
+
+def print_report(report: dict):
+    print(f"Пользователей: {report['users']}, параллельно: {report['concurrency']}, режим: {report['mode']}")
+    print(f"{'Шаг':<14}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'ошибок':>8}")
+    for name, step in report["steps"].items():
+        cells = [f"{step[key]:>10}" if step[key] is not None else f"{'-':>10}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<14}{''.join(cells)}{step['errors']:>8}")
+    print(f"Время: {report['elapsed_seconds']} сек, {report['updates_per_second']} обновлений/сек")
+    print(f"Вызовов Bot API: {report['api_calls']} ({report['api_calls_per_user']} на пользователя)")
+    print("По методам: " + ", ".join(f"{method}={count}" for method, count in sorted(report["calls_by_method"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест POLINAFIT бота")
+    parser.add_argument("--users", type=int, default=100, help="сколько пользователей прогнать через воронку")
+    parser.add_argument("--concurrency", type=int, default=20, help="сколько пользователей одновременно")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--timeout", type=float, default=30, help="таймаут одного шага, сек")
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--bot-port", type=int, default=10080)
+    parser.add_argument("--no-spawn", action="store_true", help="не запускать bot.py (бот уже запущен)")
+    parser.add_argument("--json", action="store_true", help="вывести отчет в JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_load(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()